@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+from sspq import *
+from argparse import ArgumentParser
+
+
+
+PAYLOADS = {
+    '5K': '5K.base64',
+    '10K': '10K.base64',
+    '100K': '100K.base64'
+}
+
+# every payload starts with the time it was sent at
+TIMESTAMP = struct.Struct('!d')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: list, percentile: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * percentile), len(values) - 1)]
+
+
+async def _wait_for_server(host: str, port: int, timeout: float=10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client = Client()
+            await client.connect(host=host, port=port)
+            await client.disconnect()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def _produce(host: str, port: int, queue: str, payload: bytes, count: int, batch: int, compression: bool, confirms: bool) -> None:
+    client = Client()
+    await client.connect(host=host, port=port, compression=compression, confirms=confirms)
+    while count > 0:
+        size = min(batch, count)
+        if size == 1:
+            await client.send(TIMESTAMP.pack(time.perf_counter()) + payload, queue=queue)
+        else:
+            now = TIMESTAMP.pack(time.perf_counter())
+            await client.send_many([now + payload] * size, queue=queue)
+        count -= size
+    # with confirms this waits for the last acknowledgement
+    await client.disconnect()
+
+
+async def _consume(host: str, port: int, queue: str, batch: int, state: dict, compression: bool) -> None:
+    client = Client()
+    await client.connect(host=host, port=port, compression=compression)
+    latencies = state['latencies']
+    while True:
+        # claim the messages before requesting them, so no consumer waits for
+        # messages which are never going to come
+        size = min(batch, state['total'] - state['claimed'])
+        if size <= 0:
+            break
+        state['claimed'] += size
+        if size == 1:
+            message = await client.receive(queue=queue)
+            latencies.append(time.perf_counter() - TIMESTAMP.unpack_from(message)[0])
+            await client.confirm()
+            continue
+        # receive_many returns the messages which arrived so far, work on
+        # them while the rest of the claimed messages arrives
+        received = 0
+        while received < size:
+            messages = await client.receive_many(size - received, queue=queue)
+            now = time.perf_counter()
+            for message in messages:
+                latencies.append(now - TIMESTAMP.unpack_from(message)[0])
+            await client.confirm(len(messages))
+            received += len(messages)
+    state['finished'] = time.perf_counter()
+    await client.disconnect()
+
+
+async def run_benchmark(host: str, port: int, queue: str, payload: bytes, messages: int, producers: int, consumers: int, batch: int, compression: bool=False, confirms: bool=False) -> dict:
+    """
+    Runs one benchmark against a running server and returns the results.
+    """
+    state = {'total': messages, 'claimed': 0, 'latencies': [], 'finished': None}
+    consumer_tasks = [asyncio.ensure_future(_consume(host, port, queue, batch, state, compression)) for _ in range(consumers)]
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _produce(host, port, queue, payload, messages // producers + (1 if i < messages % producers else 0), batch, compression, confirms)
+        for i in range(producers)
+    ])
+    produced = time.perf_counter()
+    await asyncio.gather(*consumer_tasks)
+    duration = state['finished'] - start
+
+    latencies = sorted(state['latencies'])
+    size = len(payload) + TIMESTAMP.size
+    return {
+        'messages': messages,
+        'payload_bytes': size,
+        'duration_s': duration,
+        'produce_duration_s': produced - start,
+        'msgs_per_s': messages / duration,
+        'mb_per_s': messages * size / duration / 1e6,
+        'latency_s': {
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+            'p999': _percentile(latencies, 0.999),
+            'max': latencies[-1] if latencies else 0.0
+        }
+    }
+
+
+def _main(args) -> dict:
+    directory = os.path.dirname(os.path.abspath(__file__))
+    payload_path = os.path.join(directory, 'testdata', PAYLOADS[args.payload]) if args.payload in PAYLOADS else args.payload
+    with open(payload_path, 'rb') as file:
+        payload = file.read()
+
+    server = None
+    host, port = args.host, args.port
+    if args.external:
+        port = port or SSPQ_PORT
+    else:
+        port = port or _free_port()
+        command = [sys.executable, os.path.join(directory, 'server.py'), '--host', host, '-p', str(port), '-ll', 'warn'] + shlex.split(args.server_args)
+        server = subprocess.Popen(command)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(_wait_for_server(host, port))
+        if args.warmup > 0:
+            loop.run_until_complete(run_benchmark(host, port, args.queue, payload, args.warmup, args.producers, args.consumers, args.batch, args.compression, args.confirms))
+        results = loop.run_until_complete(run_benchmark(host, port, args.queue, payload, args.messages, args.producers, args.consumers, args.batch, args.compression, args.confirms))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        loop.close()
+
+    return {
+        'config': {
+            'payload': args.payload,
+            'messages': args.messages,
+            'warmup': args.warmup,
+            'producers': args.producers,
+            'consumers': args.consumers,
+            'batch': args.batch,
+            'compression': args.compression,
+            'confirms': args.confirms,
+            'server_args': args.server_args if not args.external else None
+        },
+        'results': results
+    }
+
+
+
+# Entry Point for the cli
+if __name__ == "__main__":
+    # Setup argparse
+    parser = ArgumentParser(description='SSPQ Benchmark - Measures throughput and latency of a SSPQ server', add_help=True)
+    parser.add_argument('-m', '--messages', action='store', default=10000, type=int, required=False, help='Set the number of messages to send and receive', dest='messages', metavar='<count>')
+    parser.add_argument('--warmup', action='store', default=1000, type=int, required=False, help='Set the number of messages sent and received before measuring', dest='warmup', metavar='<count>')
+    parser.add_argument('--payload', action='store', default='5K', required=False, help='Set the payload to use. Possible values are: [ 5K | 10K | 100K ] or the path to a file', dest='payload', metavar='<payload>')
+    parser.add_argument('-P', '--producers', action='store', default=1, type=int, required=False, help='Set the number of producer connections', dest='producers', metavar='<count>')
+    parser.add_argument('-C', '--consumers', action='store', default=1, type=int, required=False, help='Set the number of consumer connections', dest='consumers', metavar='<count>')
+    parser.add_argument('-b', '--batch', action='store', default=1, type=int, required=False, help='Send, receive and confirm this many messages with one package', dest='batch', metavar='<count>')
+    parser.add_argument('-z', '--compression', action='store_true', default=False, required=False, help='Flag to let the clients negotiate payload compression', dest='compression')
+    parser.add_argument('--confirms', action='store_true', default=False, required=False, help='Flag to let the producers wait for the acknowledgements of the server', dest='confirms')
+    parser.add_argument('-q', '--queue', action='store', default=DEFAULT_QUEUE, required=False, help='Set the name of the queue to use', dest='queue', metavar='<queue>')
+    parser.add_argument('-a', '--address', action='store', default='127.0.0.1', required=False, help='Set the server address', dest='host', metavar='<address>')
+    parser.add_argument('-p', '--port', action='store', default=None, type=int, required=False, help='Set the server port. Defaults to a free port for the started server', dest='port', metavar='<port>')
+    parser.add_argument('--external', action='store_true', default=False, required=False, help='Flag to benchmark an already running server instead of starting one', dest='external')
+    parser.add_argument('--server-args', action='store', default='', required=False, help='Additional arguments for the started server, e.g. "--workers 4"', dest='server_args', metavar='<args>')
+    parser.add_argument('--json', action='store', default=None, required=False, help='Write the results as json to the given file, use - for stdout', dest='json', metavar='<file>')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s v1.0.0')
+    args = parser.parse_args()
+
+    if args.payload not in PAYLOADS and not os.path.isfile(args.payload):
+        parser.error(f'Unknown payload {args.payload}')
+    if min(args.messages, args.producers, args.consumers, args.batch) < 1:
+        parser.error('Messages, producers, consumers and batch need to be at least 1')
+
+    report = _main(args)
+    results = report['results']
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        if args.json is not None:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+        print(f'{results["messages"]} messages of {results["payload_bytes"]} bytes in {results["duration_s"]:.3f}s')
+        print(f'Throughput: {results["msgs_per_s"]:.0f} msgs/s, {results["mb_per_s"]:.2f} MB/s')
+        print('Latency: p50 {p50:.6f}s, p99 {p99:.6f}s, p999 {p999:.6f}s, max {max:.6f}s'.format(**results['latency_s']))
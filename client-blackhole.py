@@ -4,17 +4,17 @@ from argparse import ArgumentParser
 
 
 
-async def _receive_msg(host: str='127.0.0.1', port: int=SSPQ_PORT, nac: bool=False, dead: bool=False, loop=None) -> None:
+async def _receive_msg(host: str='127.0.0.1', port: int=SSPQ_PORT, nac: bool=False, dead: bool=False, queue: str=DEFAULT_QUEUE) -> None:
     """
     This should only be used by the cli as a helper function to receive messages.
     """
     client = Client()
-    await client.connect(host=host, port=port, loop=loop)
+    await client.connect(host=host, port=port)
     if client.connected:
         print(f'Connected to {(host, port)}')
 
     while True:
-        msg = await client.receive(dead=dead)
+        msg = await client.receive(dead=dead, queue=queue)
         print('Message:')
         print(msg.decode())
         if not nac:
@@ -33,6 +33,7 @@ if __name__ == "__main__":
     parser.add_argument('-R', '-dr', '--dead-receive', action='store_true', default=False, required=False, help='Flag if you want to receive data from the dead letter queue', dest='dead')
     parser.add_argument('-a', '--address', action='store', default='127.0.0.1', required=False, help='Set the server address to connect to.', dest='host', metavar='<address>')
     parser.add_argument('-p', '--port', action='store', default=SSPQ_PORT, type=int, required=False, help='Set the port the server listens to', dest='port', metavar='<port>')
+    parser.add_argument('-q', '--queue', action='store', default=DEFAULT_QUEUE, required=False, help='Set the name of the queue to receive from.', dest='queue', metavar='<queue>')
     parser.add_argument('-nac', '--no-auto-confirm', action='store_true', default=False, required=False, help='Disable auto confirm. WARNING this automatically requeues the message since the conection is terminated after the command finishes', dest='nac')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s v1.0.0')
     args = parser.parse_args()
@@ -40,7 +41,7 @@ if __name__ == "__main__":
     # setup asyncio
     loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(_receive_msg(loop=loop, **args.__dict__))
+        loop.run_until_complete(_receive_msg(**args.__dict__))
     except KeyboardInterrupt:
         pass
     loop.close()
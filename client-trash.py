@@ -3,12 +3,12 @@ from sspq import *
 
 
 
-async def _send_msg(loop=None):
+async def _send_msg():
     """
     This should only be used by the cli as a helper function to send messages.
     """
     client = Client()
-    await client.connect(host='127.0.0.1', port=8888, loop=loop)
+    await client.connect(host='127.0.0.1', port=8888)
 
     for i in range(1, 100):
         #with open('testdata/10K.base64', 'rb') as file:
@@ -24,5 +24,5 @@ async def _send_msg(loop=None):
 if __name__ == "__main__":
     # setup asyncio
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(_send_msg(loop=loop))
+    loop.run_until_complete(_send_msg())
     loop.close()
@@ -1,20 +1,21 @@
 import asyncio
+import json
 from sspq import *
 from argparse import ArgumentParser
 
 
 
-async def _send_msg(message: str, host: str, port: int, retrys: int):
+async def _send_msg(message: str, host: str, port: int, retrys: int, queue: str):
     client = Client()
     await client.connect(host=host, port=port)
-    await client.send(message.encode(), retrys=retrys)
+    await client.send(message.encode(), retrys=retrys, queue=queue)
     await client.disconnect()
 
 
-async def _receive_msg(host: str, port: int, nac: bool, dead: bool):
+async def _receive_msg(host: str, port: int, nac: bool, dead: bool, queue: str):
     client = Client()
     await client.connect(host=host, port=port)
-    msg = await client.receive(dead=dead)
+    msg = await client.receive(dead=dead, queue=queue)
     print('Message:')
     print(msg.decode())
     if not nac:
@@ -23,6 +24,26 @@ async def _receive_msg(host: str, port: int, nac: bool, dead: bool):
     await client.disconnect()
 
 
+async def _admin(host: str, port: int, queue: str, args):
+    client = Client()
+    await client.connect(host=host, port=port)
+    if args.stats:
+        print(json.dumps(await client.stats(queue=queue), indent=2))
+    for count, dead in ((args.peek, False), (args.peek_dead, True)):
+        if count is not None:
+            messages = await client.peek(count, dead=dead, queue=queue)
+            print(f'Next {len(messages)} {"dead letters" if dead else "messages"}:')
+            for msg in messages:
+                print(msg.decode(errors='replace'))
+    if args.replay is not None:
+        print(f'Replayed {await client.replay(args.replay, retrys=args.retrys, queue=queue)} dead letters')
+    if args.purge:
+        print(f'Purged {await client.purge(queue=queue)} messages')
+    if args.purge_dead:
+        print(f'Purged {await client.purge(dead=True, queue=queue)} dead letters')
+    await client.disconnect()
+
+
 
 # Entry Point
 if __name__ == "__main__":
@@ -31,8 +52,15 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--send', action='store_true', required=False, help='Flag if you want to send data to the queue', dest='send')
     parser.add_argument('-r', '--receive', action='store_true', required=False, help='Flag if you want to receive data from the queue', dest='receive')
     parser.add_argument('-R', '-dr', '--dead-receive', action='store_true', required=False, help='Flag if you want to receive data from the dead letter queue', dest='dead_receive')
+    parser.add_argument('--stats', action='store_true', required=False, help='Flag to print the number of waiting, delayed and dead messages of the queue', dest='stats')
+    parser.add_argument('--peek', action='store', default=None, type=int, required=False, help='Print the next count messages of the queue without removing them', dest='peek', metavar='<count>')
+    parser.add_argument('--peek-dead', action='store', default=None, type=int, required=False, help='Print the next count messages of the dead letter queue without removing them', dest='peek_dead', metavar='<count>')
+    parser.add_argument('--replay', action='store', nargs='?', default=None, const=0, type=int, required=False, help='Move count messages, or all if no count is given, from the dead letter queue back to the queue. They get the retrys given with --retrys.', dest='replay', metavar='<count>')
+    parser.add_argument('--purge', action='store_true', required=False, help='Flag to remove all messages of the queue', dest='purge')
+    parser.add_argument('--purge-dead', action='store_true', required=False, help='Flag to remove all messages of the dead letter queue', dest='purge_dead')
     parser.add_argument('-a', '--address', action='store', default='127.0.0.1', required=False, help='Set the server address to connect to.', dest='host', metavar='<address>')
     parser.add_argument('-p', '--port', action='store', default=SSPQ_PORT, type=int, required=False, help='Set the port the server listens to', dest='port', metavar='<port>')
+    parser.add_argument('-q', '--queue', action='store', default=DEFAULT_QUEUE, required=False, help='Set the name of the queue to use. Queues are created on demand.', dest='queue', metavar='<queue>')
     parser.add_argument('-m', '--message', action='store', default='', required=False, help='Set the message to send', dest='message', metavar='<message>')
     parser.add_argument('--retrys', action='store', default='3', type=int, choices=range(0,256), required=False, help='Set the amount of retrys for failed messages. A value of 255 is used to indicate infinite retrys.', dest='retrys', metavar='[0-255]')
     parser.add_argument('-nac', '--no-auto-confirm', action='store_true', required=False, help='Disable auto confirm. WARNING this automatically requeues the message since the conection is terminated after the command finishes', dest='nac')
@@ -46,9 +74,11 @@ if __name__ == "__main__":
     # setup asyncio
     loop = asyncio.get_event_loop()
     if args.send:
-        loop.run_until_complete(_send_msg(args.message, host=args.host, port=args.port, retrys=args.retrys))
+        loop.run_until_complete(_send_msg(args.message, host=args.host, port=args.port, retrys=args.retrys, queue=args.queue))
     if args.receive:
-        loop.run_until_complete(_receive_msg(host=args.host, port=args.port, nac=args.nac, dead=False))
+        loop.run_until_complete(_receive_msg(host=args.host, port=args.port, nac=args.nac, dead=False, queue=args.queue))
     if args.dead_receive:
-        loop.run_until_complete(_receive_msg(host=args.host, port=args.port, nac=args.nac, dead=True))
+        loop.run_until_complete(_receive_msg(host=args.host, port=args.port, nac=args.nac, dead=True, queue=args.queue))
+    if args.stats or args.peek is not None or args.peek_dead is not None or args.replay is not None or args.purge or args.purge_dead:
+        loop.run_until_complete(_admin(host=args.host, port=args.port, queue=args.queue, args=args))
     loop.close()
@@ -0,0 +1,72 @@
+"""
+This is the index the sspq server uses to drop messages sent twice with the
+same message id. Only an 8 byte hash of every id is kept, in generations of
+sets covering a part of the time window each. Expired ids are dropped a whole
+generation at a time, so neither adding nor expiring an id needs to touch
+more than a few sets.
+"""
+import struct
+import time
+from collections import deque
+from hashlib import blake2b
+
+
+__all__ = [
+    'DedupIndex'
+]
+
+
+
+#
+# --- Constants ---
+#
+# length of the scope in front of the hashed scope and id
+SCOPE = struct.Struct('!I')
+
+
+
+#
+# --- Classes ---
+#
+class DedupIndex():
+    """
+    This remembers the ids of recently seen messages for at least window
+    seconds. If more than size ids are remembered, the oldest generations
+    are dropped early, so the memory used stays bounded. Ids are remembered
+    per scope, e.g. the queue a message was sent to.
+    """
+    def __init__(self, window: float, size: int, generations: int=8):
+        self.window = window
+        self.size = size
+        self.span = window / generations
+        self.generation_size = max(size // generations, 1)
+        self.generations = deque()
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, scope: bytes, id: bytes) -> bool:
+        """
+        Remembers the id and returns False if it was already seen within the
+        window, True otherwise.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        key = int.from_bytes(blake2b(SCOPE.pack(len(scope)) + scope + id, digest_size=8).digest(), 'big')
+        for _, ids in self.generations:
+            if key in ids:
+                return False
+        if not self.generations or self.generations[-1][0] + self.span <= now or len(self.generations[-1][1]) >= self.generation_size:
+            self.generations.append((now, set()))
+        self.generations[-1][1].add(key)
+        self.count += 1
+        return True
+
+    def _expire(self, now: float) -> None:
+        generations = self.generations
+        # a generation holds the ids of span seconds after it was started
+        while generations and generations[0][0] + self.span + self.window <= now:
+            self.count -= len(generations.popleft()[1])
+        while len(generations) > 1 and self.count >= self.size:
+            self.count -= len(generations.popleft()[1])
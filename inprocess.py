@@ -0,0 +1,149 @@
+"""
+This connects clients to a sspq server running in the same process without
+any socket. Both ends of the connection are transports handing the written
+data directly to the protocol of the other end, so the server handles the
+connection like any other one.
+"""
+import asyncio
+
+
+__all__ = [
+    'connect_in_process',
+    'MemoryTransport'
+]
+
+
+
+#
+# --- Classes ---
+#
+class MemoryTransport(asyncio.Transport):
+    """
+    This is one end of an in-process connection. Written data is received by
+    the other end in the next iteration of the loop. There is no write buffer,
+    but reading can be paused like with a socket.
+    """
+    def __init__(self, loop, protocol: asyncio.Protocol, peername: str):
+        super().__init__({'peername': peername, 'sockname': peername})
+        self.loop = loop
+        self.protocol = protocol
+        self.peer = None
+        self.paused = False
+        self.pending = []
+        self.closing = False
+        self.lost = False
+        # the writes of the other end sent to and received by this end
+        self.sent = 0
+        self.received = 0
+
+    def write(self, data: bytes) -> None:
+        self.writelines([data])
+
+    def writelines(self, buffers: list) -> None:
+        if self.closing:
+            return
+        data = b''.join(buffers)
+        if data:
+            self.peer.sent += 1
+            self.loop.call_soon(self.peer._receive, data)
+
+    def _receive(self, data: bytes) -> None:
+        self.received += 1
+        if self.lost:
+            return
+        # keep the order with the data held back while reading was paused
+        if self.paused or self.pending:
+            self.pending.append(data)
+            return
+        self.protocol.data_received(data)
+
+    def _flush(self) -> None:
+        if self.lost or self.paused or not self.pending:
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        self.protocol.data_received(data)
+
+    def pause_reading(self) -> None:
+        self.paused = True
+
+    def resume_reading(self) -> None:
+        if self.paused:
+            self.paused = False
+            self.loop.call_soon(self._flush)
+
+    def is_reading(self) -> bool:
+        return not self.paused
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def get_write_buffer_limits(self) -> tuple:
+        return (0, 64 * 1024)
+
+    def set_write_buffer_limits(self, high: int=None, low: int=None) -> None:
+        pass
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self) -> None:
+        """
+        Closes both ends. Like with a socket, the other end still receives
+        everything written before. This end still receives everything the
+        other end wrote before, including what it writes in callbacks which
+        are already scheduled.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.call_soon(self._close, None)
+
+    def _close(self, until: int) -> None:
+        if self.lost:
+            return
+        if until is None:
+            until = self.sent
+        if self.received < until:
+            self.loop.call_soon(self._close, until)
+            return
+        self.lost = True
+        self.pending = []
+        self.loop.call_soon(self.protocol.connection_lost, None)
+        self.loop.call_soon(self.peer._lost)
+
+    def abort(self) -> None:
+        self.close()
+
+    def _lost(self) -> None:
+        if self.lost:
+            return
+        self.closing = True
+        self.lost = True
+        self.pending = []
+        self.protocol.eof_received()
+        self.protocol.connection_lost(None)
+
+
+
+#
+# --- Functions ---
+#
+def connect_in_process(server_protocol: asyncio.Protocol, loop=None) -> (asyncio.StreamReader, asyncio.StreamWriter):
+    """
+    Connects a new stream reader and writer to the given protocol of the
+    server and returns them like asyncio.open_connection.
+    """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    reader = asyncio.StreamReader(loop=loop)
+    client_protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    client = MemoryTransport(loop, client_protocol, 'in-process')
+    server = MemoryTransport(loop, server_protocol, 'in-process')
+    client.peer = server
+    server.peer = client
+    server_protocol.connection_made(server)
+    client_protocol.connection_made(client)
+    return reader, asyncio.StreamWriter(client, client_protocol, reader, loop)
@@ -0,0 +1,64 @@
+"""
+This contains the token buckets the sspq server uses to limit the rate at
+which producers enqueue messages. Taking tokens never blocks, a bucket can go
+into debt and tells how long it takes to pay it back, which is the time the
+server stops reading from the producer.
+"""
+import time
+
+
+__all__ = [
+    'RateLimit',
+    'TokenBucket'
+]
+
+
+
+#
+# --- Classes ---
+#
+class TokenBucket():
+    """
+    This allows rate tokens per second and bursts of up to burst tokens,
+    which default to the tokens of one second.
+    """
+    def __init__(self, rate: float, burst: float=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> float:
+        """
+        Takes amount tokens and returns the seconds until the bucket is out
+        of debt again, which is 0 if there were enough tokens.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimit():
+    """
+    This limits messages per second and bytes per second, either of them
+    may be None for no limit.
+    """
+    def __init__(self, messages: float=None, bytes: float=None):
+        self.messages = TokenBucket(messages) if messages else None
+        self.bytes = TokenBucket(bytes) if bytes else None
+
+    def take(self, count: int, size: int) -> float:
+        """
+        Accounts count messages with size payload bytes and returns the
+        seconds until both limits allow more messages again.
+        """
+        delay = 0.0
+        if self.messages is not None:
+            delay = self.messages.take(count)
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.take(size))
+        return delay
@@ -0,0 +1,151 @@
+"""
+This contains the counters, gauges and histograms the sspq server collects
+and a tiny http server exposing them in the prometheus text format. Updating a
+metric is just an addition, so they can be used on every message.
+"""
+import asyncio
+from bisect import bisect_left
+
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'render',
+    'start_metrics_server'
+]
+
+
+
+#
+# --- Constants ---
+#
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+REGISTRY = []
+
+
+
+#
+# --- Classes ---
+#
+class Counter():
+    """
+    This is a value which only goes up.
+    """
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        REGISTRY.append(self)
+
+    def inc(self, amount: int=1) -> None:
+        self.value += amount
+
+    def render(self) -> list:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} counter',
+            f'{self.name} {self.value}'
+        ]
+
+
+class Gauge():
+    """
+    This is a value which is read from a callback when the metrics are
+    rendered. The callback returns a dict from label values to values.
+    """
+    def __init__(self, name: str, help: str, label: str, callback):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def render(self) -> list:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} gauge'
+        ]
+        for label, value in self.callback().items():
+            lines.append(f'{self.name}{{{self.label}="{_escape(label)}"}} {value}')
+        return lines
+
+
+class Histogram():
+    """
+    This counts observed values in fixed buckets.
+    """
+    def __init__(self, name: str, help: str, buckets: tuple=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        REGISTRY.append(self)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> list:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} histogram'
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+
+#
+# --- Functions ---
+#
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render() -> str:
+    """
+    Renders all metrics in the prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _metrics_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        # the request itself doesn't matter, every path returns the metrics
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        body = render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Starts a http server which answers every request with the metrics.
+    """
+    return await asyncio.start_server(_metrics_handler, host, port)
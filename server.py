@@ -1,210 +1,1944 @@
 import asyncio
-from enum import Enum
+import base64
+import heapq
+import itertools
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque, OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from sspq import *
-from argparse import ArgumentParser, ArgumentTypeError
-
-
-
-class OrderedEnum(Enum):
-    def __ge__(self, other):
-        if self.__class__ is other.__class__:
-            return self.value >= other.value
-        return NotImplemented
-    def __gt__(self, other):
-        if self.__class__ is other.__class__:
-            return self.value > other.value
-        return NotImplemented
-    def __le__(self, other):
-        if self.__class__ is other.__class__:
-            return self.value <= other.value
-        return NotImplemented
-    def __lt__(self, other):
-        if self.__class__ is other.__class__:
-            return self.value < other.value
-        return NotImplemented
-
-
-class LogLevel(OrderedEnum):
-    FAIL = '1'
-    WARN = '2'
-    INFO = '3'
-    DBUG = '4'
-
-    @classmethod
-    def parse(cls, string: str) -> super:
-        _string = string.lower()
-        if _string == 'fail':
-            return cls.FAIL
-        if _string == 'warn':
-            return cls.WARN
-        if _string == 'info':
-            return cls.INFO
-        if _string == 'dbug':
-            return cls.DBUG
-        raise ArgumentTypeError(string + ' is NOT a valid loglevel')
+from dedup import DedupIndex
+from limits import RateLimit
+from metrics import Counter, Gauge, Histogram, start_metrics_server
+from timers import TimerWheel
+from spill import SpillStore
+from wal import DEAD, encode_record, ENQUEUE, read_records, record_of, REMOVE, WriteAheadLog
+from inprocess import connect_in_process
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+
+
+
+WAL_QUEUE_PREFIX = 'queue-'
+# messages purged or replayed by an admin command before other clients are served again
+ADMIN_BATCH = 1000
+# packages which refer to the queue of the unconfirmed messages
+RECEIVED_TYPES = (MessageType.CONFIRM, MessageType.CONFIRM_MANY, MessageType.EXTEND)
+# packages still handled while a producer is paused, so it can go on consuming
+CONSUMING_TYPES = (MessageType.RECEIVE, MessageType.DEAD_RECEIVE, MessageType.RECEIVE_MANY, MessageType.DEAD_RECEIVE_MANY) + RECEIVED_TYPES
+# packages still handled once a client with held back packages closed the connection
+CLOSED_TYPES = (MessageType.SEND, MessageType.SEND_BATCH, MessageType.QUEUE, MessageType.CONFIRM, MessageType.CONFIRM_MANY)
+# bytes of packages held back from a paused producer before reading from it stops
+HELD_SIZE = 64 * 1024
+# kind of a REPLICATE package, length of the queue name
+REPLICATION = struct.Struct('!BH')
+REPLICATION_RECORDS = 0
+REPLICATION_SNAPSHOT_BEGIN = 1
+REPLICATION_SNAPSHOT_END = 2
+# bytes of records sent to a subscribing standby before waiting for it to read them
+SNAPSHOT_BATCH = 1024 * 1024
+# seconds the connections of the clients have to close when the server stops
+CLOSE_TIMEOUT = 1.0
+
+
+
+LOG_LEVELS = {
+    'fail': logging.ERROR,
+    'warn': logging.WARNING,
+    'info': logging.INFO,
+    'dbug': logging.DEBUG
+}
+
+logger = logging.getLogger('sspq.server')
+# the SSPQServer running in this process, only one can run at a time
+embedded = None
+
+ENQUEUED = Counter('sspq_messages_enqueued_total', 'Messages sent to the server')
+DISPATCHED = Counter('sspq_messages_dispatched_total', 'Messages sent to consumers')
+CONFIRMED = Counter('sspq_messages_confirmed_total', 'Messages confirmed by consumers')
+REQUEUED = Counter('sspq_messages_requeued_total', 'Unconfirmed messages put back into their queue')
+DEAD_LETTERED = Counter('sspq_messages_dead_lettered_total', 'Unconfirmed messages moved to the dead letter queue')
+PURGED = Counter('sspq_messages_purged_total', 'Messages removed by the purge admin command')
+REPLAYED = Counter('sspq_messages_replayed_total', 'Dead letters moved back to their queue by the replay admin command')
+DUPLICATES = Counter('sspq_messages_duplicate_total', 'Messages dropped because a message with the same id was sent shortly before')
+EXPIRED = Counter('sspq_messages_expired_total', 'Unconfirmed messages whose visibility timeout ran out')
+DROPPED = Counter('sspq_messages_dropped_total', 'Unconfirmed messages dropped without dead letter queue')
+PAUSED = Counter('sspq_producer_pauses_total', 'Times a producer was paused by a rate limit or a full queue')
+BYTES_IN = Counter('sspq_bytes_in_total', 'Payload bytes sent to the server')
+BYTES_OUT = Counter('sspq_bytes_out_total', 'Payload bytes sent to consumers')
+ENQUEUE_LATENCY = Histogram('sspq_enqueue_seconds', 'Time to put a message into a queue')
+DISPATCH_LATENCY = Histogram('sspq_dispatch_seconds', 'Time messages wait in the queue until they are sent to a consumer')
+CONFIRM_LATENCY = Histogram('sspq_confirm_seconds', 'Time from sending a message to a consumer until it is confirmed')
+QUEUE_DEPTH = Gauge('sspq_queue_depth', 'Messages waiting in a queue', 'queue', lambda: {name: queue.message_queue.qsize() for name, queue in queues.items()})
+DELAYED_DEPTH = Gauge('sspq_delayed_messages', 'Messages of a queue waiting for their delivery time', 'queue', lambda: {name: len(queue.delayed) for name, queue in queues.items()})
+DEAD_LETTER_QUEUE_DEPTH = Gauge('sspq_dead_letter_queue_depth', 'Messages waiting in a dead letter queue', 'queue', lambda: {name: queue.dead_letter_queue.qsize() for name, queue in queues.items()})
+WAITING_CONSUMERS = Gauge('sspq_waiting_consumers', 'Consumers waiting for messages of a queue', 'queue', lambda: {name: len(queue.consumers) for name, queue in queues.items()})
+
 
 
 class Server_Client():
     """
-    This represents a client connected to a server.
+    This represents a client connected to a server. With the protocol engine
+    there is no reader and the writer is the transport.
     """
+    __slots__ = ('reader', 'writer', 'address', 'queue_name', 'receive_name', 'receive_queue', 'in_flight', 'credit', 'timeout', 'codecs', 'dead', 'disconnected', 'upstreams', 'replica', 'limit', 'resumed', 'throttle', 'blocked_by', 'draining', 'held', 'held_size', 'held_queue', 'closed', 'acks', 'sequence', 'acked', 'ack_handle')
+
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.reader = reader
-        self.writer = writer
+        self.writer = FrameWriter(writer)
         self.address = writer.get_extra_info('peername')
-        self.message = None
+        self.queue_name = DEFAULT_QUEUE
+        self.receive_name = DEFAULT_QUEUE
+        self.receive_queue = None
+        self.in_flight = deque()
+        self.credit = 0
+        self.timeout = None
+        self.codecs = b''
+        self.dead = False
         self.disconnected = False
-        self.message_event = asyncio.Event()
+        self.upstreams = {}
+        self.replica = None
+        self.limit = RateLimit(*CLIENT_LIMIT) if CLIENT_LIMIT is not None else None
+        # a future while the client is paused as a producer
+        self.resumed = None
+        self.throttle = None
+        self.blocked_by = None
+        self.draining = None
+        # the packages held back while the client is paused, once a QUEUE
+        # package is held back all packages after it are held back as well
+        self.held = deque()
+        self.held_size = 0
+        self.held_queue = False
+        # the client closed the connection, he is disconnected once his held
+        # back packages are handled
+        self.closed = False
+        # the send packages waiting for their acknowledgement, if the client
+        # enabled them
+        self.acks = None
+        self.sequence = 0
+        self.acked = 0
+        self.ack_handle = None
 
+    def send(self, message: Message) -> None:
+        if not self.disconnected and not self.closed:
+            self.writer.writelines(message.frame())
 
 
-def get_user_handler(log_level: LogLevel=LogLevel.INFO, retry_override: int=None):
-    async def user_handler(reader, writer):
-        client = Server_Client(reader=reader, writer=writer)
-        if log_level >= LogLevel.INFO:
-            print(f'User {client.address} connected')
+class Delivery():
+    """
+    This is a message sent to a client which is not confirmed yet.
+    """
+    __slots__ = ('message', 'timeout', 'timer', 'expired')
 
-        while True:
-            try:
-                msg = await read_message(client.reader)
-            except MessageException as e:
-                if log_level >= LogLevel.WARN:
-                    print(f'User {client.address} disconnected because: {e}')
-                client.disconnected = True
-                client.message_event.set()
-                client.writer.close()
-                return
-            except EOFError:
-                if log_level >= LogLevel.INFO:
-                    print(f'User {client.address} disconnected')
-                client.disconnected = True
-                client.message_event.set()
-                client.writer.close()
+    def __init__(self, message: Message, timeout: float=None):
+        self.message = message
+        # the visibility timeout the message was received with
+        self.timeout = timeout
+        self.timer = None
+        self.expired = False
+
+
+class Upstream():
+    """
+    This is the connection of a client to another worker, which is used to
+    forward the packages for queues owned by that worker.
+    """
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.pending = []
+        self.queue_name = DEFAULT_QUEUE
+        self.relay = None
+        # the acknowledgements of the client waiting for the worker
+        self.sequence = 0
+        self.acks = deque()
+
+    def connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Sends the packages held back while the connection was opened.
+        """
+        self.reader = reader
+        self.writer = FrameWriter(writer)
+        for message in self.pending:
+            self.writer.writelines(message.frame())
+        self.pending = []
+
+    def send(self, message: Message) -> None:
+        if self.writer is None:
+            self.pending.append(message)
+        else:
+            self.writer.writelines(message.frame())
+
+    def full(self) -> bool:
+        """
+        Returns whether the worker doesn't keep up with the forwarded packages.
+        """
+        return self.writer is not None and self.writer.full()
+
+
+class Acknowledgement():
+    """
+    This is a send package of a client which is acknowledged once it and all
+    packages sent before it are done.
+    """
+    __slots__ = ('sequence', 'done')
+
+    def __init__(self, sequence: int):
+        self.sequence = sequence
+        self.done = False
+
+
+class Replica():
+    """
+    This is a standby server following the changes of the queues. The records
+    are collected per queue and sent as one package per queue once the
+    current callbacks are done, so a batch of messages costs one package.
+    While the snapshot is streamed or the standby doesn't keep up, the
+    records are collected until it caught up and the producers are paused.
+    """
+    def __init__(self, client: 'Server_Client'):
+        self.client = client
+        self.records = {}
+        self.handle = None
+        self.draining = None
+        self.snapshot = None
+        # producers paused until the standby caught up
+        self.blocked = set()
+
+    @property
+    def behind(self) -> bool:
+        return self.snapshot is not None or self.draining is not None
+
+    def add(self, name: str, id: int, record: Message) -> None:
+        records = self.records.get(name)
+        if records is None:
+            records = self.records[name] = []
+        records.append(encode_record(id, record))
+        if self.handle is None and not self.behind:
+            self.handle = loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.handle = None
+        records, self.records = self.records, {}
+        for name, data in records.items():
+            self.client.send(replication_package(REPLICATION_RECORDS, name, b''.join(data)))
+        if self.draining is None and self.client.writer.full():
+            self.draining = asyncio.ensure_future(self.drain())
+
+    async def drain(self) -> None:
+        """
+        Waits for the standby to read the packages sent before.
+        """
+        try:
+            await self.client.writer.drain()
+        except ConnectionError:
+            # the standby is disconnected by its handler
+            return
+        finally:
+            self.draining = None
+        self.caught_up()
+
+    def caught_up(self) -> None:
+        """
+        Sends the records collected while the standby was behind and resumes
+        the producers unless it is behind again.
+        """
+        if self.records:
+            self.flush()
+        if self.behind:
+            return
+        blocked, self.blocked = self.blocked, set()
+        for client in blocked:
+            client.blocked_by = None
+            resume(client)
+
+    def close(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        for task in (self.draining, self.snapshot):
+            if task is not None:
+                task.cancel()
+        self.draining = None
+        self.snapshot = None
+        self.records = {}
+        self.caught_up()
+
+
+class ConsumerRegistry():
+    """
+    This holds the clients waiting for messages of a queue. The clients are
+    served round-robin and a disconnected client is removed immediately.
+    """
+    def __init__(self):
+        self.consumers = OrderedDict()
+        self.available = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.consumers)
+
+    def add(self, client: 'Server_Client') -> None:
+        """
+        Adds the client to the end of the line.
+        """
+        self.consumers[client] = None
+        self.available.set()
+
+    def discard(self, client: 'Server_Client') -> None:
+        """
+        Removes the client if it is waiting.
+        """
+        self.consumers.pop(client, None)
+
+    async def wait(self) -> None:
+        """
+        Waits until at least one client is waiting.
+        """
+        while not self.consumers:
+            self.available.clear()
+            await self.available.wait()
+
+    async def get(self) -> 'Server_Client':
+        """
+        Removes and returns the client which waits the longest.
+        """
+        await self.wait()
+        return self.consumers.popitem(last=False)[0]
+
+    def pop(self) -> 'Server_Client':
+        """
+        Removes and returns the client which waits the longest, or None if no
+        client is waiting.
+        """
+        if not self.consumers:
+            return None
+        return self.consumers.popitem(last=False)[0]
+
+
+class MessageHeap(asyncio.Queue):
+    """
+    This is a asyncio.Queue which returns the message with the highest
+    priority first and messages of the same priority in the order they were
+    put into it.
+    """
+    def _init(self, maxsize: int) -> None:
+        self._queue = []
+        self._order = itertools.count()
+
+    def _put(self, message: Message) -> None:
+        heapq.heappush(self._queue, (-message.priority, next(self._order), message))
+
+    def _get(self) -> Message:
+        return heapq.heappop(self._queue)[2]
+
+    def peek(self, count: int) -> list:
+        """
+        Returns the next count messages without removing them.
+        """
+        return [entry[2] for entry in heapq.nsmallest(count, self._queue)]
+
+
+class MessageFifo(asyncio.Queue):
+    """
+    This is a asyncio.Queue which allows to look at the next messages without
+    removing them.
+    """
+    def peek(self, count: int) -> list:
+        """
+        Returns the next count messages without removing them.
+        """
+        return list(itertools.islice(self._queue, count))
+
+
+class Queue():
+    """
+    This is a named message queue with its own dead letter queue, write-ahead
+    log and dispatchers.
+    """
+    def __init__(self, name: str, wal: WriteAheadLog=None):
+        self.name = name
+        self.message_queue = MessageHeap()
+        self.delayed = []
+        self.delayed_order = itertools.count()
+        self.delayed_handle = None
+        self.consumers = ConsumerRegistry()
+        # producers paused until the queue is down to the low watermark
+        self.blocked = set()
+        self.dead_letter_queue = MessageFifo()
+        self.dead_letter_consumers = ConsumerRegistry()
+        self.wal = wal
+        self.workers = []
+        # the messages which are not removed yet by their id, with the type
+        # of their last record
+        self.live = {}
+        self.next_id = 1
+
+    def recover(self) -> None:
+        """
+        Reads the live messages from the write-ahead log.
+        """
+        if self.wal is None:
+            return
+        messages, dead_letters = self.wal.recover()
+        for message in messages:
+            self.live[message.log_id] = (message, ENQUEUE)
+        for message in dead_letters:
+            self.live[message.log_id] = (message, DEAD)
+        for message in messages + dead_letters:
+            if spill is not None:
+                spill.store(message)
+        self.next_id = self.wal.next_id
+        if messages or dead_letters:
+            logger.info('Recovered %d messages and %d dead letters of queue %r', len(messages), len(dead_letters), self.name)
+
+    def restore(self) -> None:
+        """
+        Puts the live messages into the queues. This is done after the
+        recovery or, on a standby, when it is promoted.
+        """
+        now = time.perf_counter()
+        for message, type in self.live.values():
+            message.enqueued_at = now
+            if dedup is not None and message.message_id is not None:
+                dedup.add(self.name.encode(), message.message_id)
+            if type == DEAD:
+                self.dead_letter_queue.put_nowait(message)
+            else:
+                self.put(message)
+
+    def log(self, type: MessageType, message: Message) -> None:
+        """
+        Records that the message was enqueued, moved to the dead letter queue
+        or removed in the write-ahead log and on all standbys.
+        """
+        id = message.log_id
+        if type == REMOVE:
+            if self.live.pop(id, None) is None:
                 return
+        else:
+            if id is None:
+                id = message.log_id = self.next_id
+                self.next_id += 1
+            else:
+                # the latest record decides the order after a failover
+                self.live.pop(id, None)
+            self.live[id] = (message, type)
+        if self.wal is not None:
+            if type == REMOVE:
+                self.wal.remove(message)
+            elif type == DEAD:
+                self.wal.dead(message)
+            else:
+                self.wal.enqueue(message)
+        if replicas:
+            record = record_of(type, message)
+            for replica in replicas:
+                replica.add(self.name, id, record)
 
-            if msg.type == MessageType.SEND:
-                if log_level >= LogLevel.DBUG:
-                    print('Recieved: ' + msg.payload.decode())
-                if retry_override is not None:
-                    msg.retries = retry_override
-                await message_queue.put(msg)
-            elif msg.type == MessageType.RECEIVE:
-                if client.message is not None:
-                    if log_level >= LogLevel.WARN:
-                        print('Receive Message is going to be dropped because client need to confirm his message.')
-                    continue
-                if log_level >= LogLevel.DBUG:
-                    print('User{} wants to receive'.format(str(client.address)))
-                client.message_event.clear()
-                await client_queue.put(client)
-            elif msg.type == MessageType.CONFIRM:
-                if client.message is None:
-                    if log_level >= LogLevel.WARN:
-                        print('Confirm Message is going to be dropped because client has no message to confirm.')
-                    continue
-                if log_level >= LogLevel.DBUG:
-                    print('User{} confirms message'.format(str(client.address)))
-                client.message = None
-                client.message_event.set()
-                await asyncio.sleep(0)
-            elif msg.type == MessageType.DEAD_RECEIVE:
-                if client.message is not None:
-                    if log_level >= LogLevel.WARN:
-                        print('Dead-Receive Message is going to be dropped because client need to confirm his message.')
+    def put(self, message: Message) -> None:
+        """
+        Puts the message into the ready queue or, if it must not be delivered
+        yet, into the delay heap until its time has come.
+        """
+        if message.deliver_at <= time.time() * 1000:
+            self.message_queue.put_nowait(message)
+            return
+        heapq.heappush(self.delayed, (message.deliver_at, next(self.delayed_order), message))
+        if self.delayed[0][2] is message:
+            self._schedule_delayed()
+
+    def _schedule_delayed(self) -> None:
+        if self.delayed_handle is not None:
+            self.delayed_handle.cancel()
+        self.delayed_handle = loop.call_later(max(self.delayed[0][0] / 1000 - time.time(), 0), self._release_delayed)
+
+    def _release_delayed(self) -> None:
+        self.delayed_handle = None
+        now = time.time() * 1000
+        while self.delayed and self.delayed[0][0] <= now:
+            message = heapq.heappop(self.delayed)[2]
+            message.enqueued_at = time.perf_counter()
+            self.message_queue.put_nowait(message)
+        if self.delayed:
+            self._schedule_delayed()
+
+    def clear_delayed(self) -> list:
+        """
+        Removes and returns all messages waiting for their delivery time.
+        """
+        if self.delayed_handle is not None:
+            self.delayed_handle.cancel()
+            self.delayed_handle = None
+        messages = [entry[2] for entry in self.delayed]
+        self.delayed = []
+        return messages
+
+    def start(self, loop) -> None:
+        self.workers = [
+            asyncio.ensure_future(queue_handler(self, loop=loop), loop=loop),
+            asyncio.ensure_future(dead_letter_queue_handler(self, loop=loop, active=(not NDLQ)), loop=loop)
+        ]
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        if self.delayed_handle is not None:
+            self.delayed_handle.cancel()
+        if self.wal is not None:
+            self.wal.close()
+
+
+
+def get_queue(name: str) -> Queue:
+    """
+    Returns the queue with the given name and creates it if it doesn't exist.
+    """
+    queue = queues.get(name)
+    if queue is None:
+        wal = None
+        if WAL_DIR is not None:
+            wal = WriteAheadLog(wal_directory(name), **WAL_OPTIONS)
+        queue = Queue(name, wal)
+        queue.recover()
+        if not STANDBY:
+            queue.restore()
+        queue.start(loop)
+        queues[name] = queue
+    return queue
+
+
+def shard_of(name: str) -> int:
+    """
+    Returns the number of the worker owning the queue with the given name.
+    """
+    return zlib.crc32(name.encode()) % WORKERS
+
+
+def ipc_path(worker: int) -> str:
+    return os.path.join(IPC_DIR, f'worker-{worker}.sock')
+
+
+def wal_directory(name: str) -> str:
+    """
+    Returns the log directory of a queue. The default queue uses the log
+    directory itself, all other queues use a sub directory.
+    """
+    if name == DEFAULT_QUEUE:
+        return WAL_DIR
+    return os.path.join(WAL_DIR, WAL_QUEUE_PREFIX + name.encode().hex())
+
+
+def get_user_handler(retry_override: int=None):
+    async def user_handler(reader, writer):
+        client = Server_Client(reader=reader, writer=writer)
+        clients.add(client)
+        logger.info('User %s connected', client.address)
+
+        try:
+            while not client.disconnected:
+                if client.resumed is not None and client.held_size >= HELD_SIZE:
+                    # the unread packages pile up in the socket buffers and
+                    # eventually stop the client from sending
+                    await client.resumed
                     continue
-                if log_level >= LogLevel.DBUG:
-                    print('User{} wants to dead receive'.format(str(client.address)))
-                client.message_event.clear()
-                await dead_letter_client_queue.put(client)
-            else:
-                if log_level >= LogLevel.WARN:
-                    print('Received unknown packet:\n' + msg.encode().decode())
-                await asyncio.sleep(0)
+                try:
+                    msg = await read_message(client.reader)
+                    handle_package(client, msg, retry_override)
+                except MessageException as e:
+                    logger.warning('User %s disconnected because: %s', client.address, e)
+                    disconnect(client)
+                    return
+                except EOFError:
+                    logger.info('User %s disconnected', client.address)
+                    hang_up(client)
+                    return
+        except asyncio.CancelledError:
+            # the server is stopped, the unconfirmed messages are requeued
+            # while the queues are still running
+            disconnect(client)
+            raise
     return user_handler
 
 
-async def message_handler(message: Message, client: Server_Client):
-    client.message = message
-    await message.send(client.writer)
-    await client.message_event.wait()
-    if client.message is not None:
-        if client.message.retries == 0:
-            if not NDLQ:
-                await dead_letter_queue.put(client.message)
+class ServerProtocol(asyncio.Protocol):
+    """
+    This is the protocol based engine of the server. The packages are parsed
+    incrementally from the received data and handled right away, so an idle
+    connection costs no coroutine, only this protocol and its client.
+    """
+    __slots__ = ('retry_override', 'client', 'buffer', 'paused')
+
+    def __init__(self, retry_override: int=None):
+        self.retry_override = retry_override
+        self.client = None
+        self.buffer = bytearray()
+        self.paused = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.client = Server_Client(reader=None, writer=transport)
+        clients.add(self.client)
+        logger.info('User %s connected', self.client.address)
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer.extend(data)
+        if not self.handle_buffer(HELD_SIZE):
+            return
+        client = self.client
+        if client.held_size >= HELD_SIZE and not self.paused:
+            self.paused = True
+            client.writer.transport.pause_reading()
+            if client.resumed is not None:
+                client.resumed.add_done_callback(self.resume)
+            else:
+                # the client was just resumed, the held back packages are
+                # handled in one of the next callbacks
+                loop.call_soon(self.resume, None)
+
+    def handle_buffer(self, limit: int) -> bool:
+        """
+        Handles the complete packages in the buffer until the given bytes
+        are held back. Returns False if the client was disconnected because
+        of an invalid package.
+        """
+        client = self.client
+        buffer = self.buffer
+        offset = 0
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - offset >= HEADER.size and not client.disconnected and client.held_size < limit:
+                mv, _type, retries, size = HEADER.unpack_from(buffer, offset)
+                if mv != MAGIC_VALUE:
+                    raise MessageException('Magic value check failed')
+                end = offset + HEADER.size + (size & SIZE_MASK)
+                if end > len(buffer):
+                    break
+                msg = Message.decode(_type, retries, size, view[offset + HEADER.size:end].tobytes())
+                offset = end
+                handle_package(client, msg, self.retry_override)
+        except MessageException as e:
+            logger.warning('User %s disconnected because: %s', client.address, e)
+            disconnect(client)
+            return False
+        finally:
+            view.release()
+        del buffer[:offset]
+        return True
+
+    def resume(self, future: asyncio.Future) -> None:
+        """
+        Reads from the client again and handles the packages received before
+        reading was paused, once the held back packages are handled.
+        """
+        self.paused = False
+        if not self.client.disconnected and not self.client.closed:
+            self.client.writer.transport.resume_reading()
+            self.data_received(b'')
+
+    def pause_writing(self) -> None:
+        self.client.writer.pause_writing()
+
+    def resume_writing(self) -> None:
+        self.client.writer.resume_writing()
+
+    def connection_lost(self, exc: Exception) -> None:
+        if self.client.disconnected:
+            return
+        # the packages received before are handled like with the streams
+        # engine, nothing more is read anyway
+        self.client.closed = True
+        if not self.handle_buffer(sys.maxsize):
+            return
+        if self.buffer:
+            logger.warning('User %s disconnected because: Incomplete message', self.client.address)
         else:
-            if client.message.retries != 255:
-                client.message.retries -= 1
-            await message_queue.put(client.message)
+            logger.info('User %s disconnected', self.client.address)
+        hang_up(self.client)
 
 
-async def queue_handler(loop):
-    while True:
-        msg = await message_queue.get()
-        client = await client_queue.get()
-        while client.disconnected:
-            client = await client_queue.get()
-        asyncio.ensure_future(message_handler(msg, client), loop=loop)
+def handle_package(client: Server_Client, msg: Message, retry_override: int=None):
+    """
+    Handles a package of a client or holds it back while the client is paused
+    as a producer. Only the packages of the producer are held back, so a
+    paused client can still receive and confirm messages.
+    """
+    if client.closed and msg.type not in CLOSED_TYPES:
+        return
+    if client.held or client.resumed is not None:
+        if msg.type not in CONSUMING_TYPES or client.held_queue:
+            if not client.held:
+                client.resumed.add_done_callback(lambda future: release(client, retry_override))
+            client.held.append(msg)
+            client.held_size += HEADER.size + msg.payload_size
+            client.held_queue = client.held_queue or msg.type == MessageType.QUEUE
+            return
+    handle_message(client, msg, retry_override)
+
+
+def release(client: Server_Client, retry_override: int=None):
+    """
+    Handles the packages held back from a resumed client until it is paused
+    again.
+    """
+    try:
+        while client.held and client.resumed is None and not client.disconnected:
+            msg = client.held.popleft()
+            client.held_size -= HEADER.size + msg.payload_size
+            if client.closed and msg.type not in CLOSED_TYPES:
+                continue
+            handle_message(client, msg, retry_override)
+    except MessageException as e:
+        logger.warning('User %s disconnected because: %s', client.address, e)
+        disconnect(client)
+        return
+    if not client.held:
+        client.held_queue = False
+        if client.closed:
+            disconnect(client)
+    elif client.resumed is not None:
+        client.resumed.add_done_callback(lambda future: release(client, retry_override))
+
+
+def handle_message(client: Server_Client, msg: Message, retry_override: int=None):
+    """
+    Handles a single package of a client, which is the same for both server
+    engines. A MessageException is raised if the client has to be
+    disconnected because of an invalid package.
+    """
+    if WORKERS > 1 and msg.type not in (MessageType.QUEUE, MessageType.HELLO, MessageType.REPLICATE, MessageType.ACK):
+        name = client.receive_name if msg.type in RECEIVED_TYPES else client.queue_name
+        shard = shard_of(name)
+        if shard != WORKER:
+            if msg.type in (MessageType.RECEIVE, MessageType.DEAD_RECEIVE, MessageType.RECEIVE_MANY, MessageType.DEAD_RECEIVE_MANY):
+                client.receive_name = name
+            forward(client, shard, name, msg)
+            return
+
+    if msg.type == MessageType.SEND:
+        logger.debug('User %s sent a message of %d bytes', client.address, msg.payload_size)
+        if retry_override is not None:
+            msg.retries = retry_override
+        queue = get_queue(client.queue_name)
+        enqueue(queue, msg)
+        if client.acks is not None:
+            accept(client, queue)
+        throttle(client, queue, 1, msg.payload_size)
+    elif msg.type == MessageType.SEND_BATCH:
+        batch = decode_batch(msg.payload)
+        logger.debug('User %s sent a batch of %d messages', client.address, len(batch))
+        queue = get_queue(client.queue_name)
+        for _msg in batch:
+            if _msg.type != MessageType.SEND:
+                continue
+            if retry_override is not None:
+                _msg.retries = retry_override
+            enqueue(queue, _msg)
+        if client.acks is not None:
+            accept(client, queue)
+        throttle(client, queue, len(batch), msg.payload_size)
+    elif msg.type == MessageType.HELLO:
+        client.codecs = bytes(codec for codec in msg.payload if codec in CODECS)
+        logger.debug('User %s can decompress codecs %s', client.address, list(client.codecs))
+        for upstream in client.upstreams.values():
+            hello(upstream, client.codecs)
+        hello(client, bytes(sorted(CODECS)))
+    elif msg.type == MessageType.ACK:
+        if client.acks is None:
+            logger.debug('User %s enables acknowledgements', client.address)
+            client.acks = deque()
+            for upstream in client.upstreams.values():
+                upstream.send(Message(MessageType.ACK))
+        client.send(ack_package(client.acked))
+    elif msg.type == MessageType.ADMIN:
+        try:
+            request = json.loads(msg.payload.decode())
+        except (UnicodeDecodeError, ValueError):
+            raise MessageException('Invalid admin request')
+        logger.info('User %s runs admin request %r on queue %r', client.address, request, client.queue_name)
+        asyncio.ensure_future(admin(client, get_queue(client.queue_name), request))
+    elif msg.type == MessageType.REPLICATE:
+        if WORKERS > 1:
+            raise MessageException('Replication needs a server with a single worker')
+        if client.replica is None:
+            logger.info('Standby %s subscribed to the queues', client.address)
+            subscribe(client)
+    elif msg.type == MessageType.QUEUE:
+        try:
+            name = msg.payload.decode()
+        except UnicodeDecodeError:
+            raise MessageException('Invalid queue name')
+        logger.debug('User %s selects queue %r', client.address, name)
+        client.queue_name = name
+    elif msg.type in (MessageType.RECEIVE, MessageType.DEAD_RECEIVE):
+        dead = msg.type == MessageType.DEAD_RECEIVE
+        if client.in_flight or client.credit > 0:
+            logger.warning('%s Message is going to be dropped because client need to confirm his message.', 'Dead-Receive' if dead else 'Receive')
+            return
+        logger.debug('User %s wants to %sreceive', client.address, 'dead ' if dead else '')
+        request_messages(client, 1, dead, read_timeout(msg, 0))
+    elif msg.type in (MessageType.RECEIVE_MANY, MessageType.DEAD_RECEIVE_MANY):
+        dead = msg.type == MessageType.DEAD_RECEIVE_MANY
+        if (client.in_flight or client.credit > 0) and (client.dead != dead or client.receive_queue is not get_queue(client.queue_name)):
+            logger.warning('Receive Message is going to be dropped because client can\'t mix messages of different queues.')
+            return
+        count = read_count(msg)
+        logger.debug('User %s wants to %sreceive %d messages', client.address, 'dead ' if dead else '', count)
+        request_messages(client, count, dead, read_timeout(msg, COUNT.size))
+    elif msg.type in (MessageType.CONFIRM, MessageType.CONFIRM_MANY):
+        if not client.in_flight:
+            logger.warning('Confirm Message is going to be dropped because client has no message to confirm.')
+            return
+        count = 1 if msg.type == MessageType.CONFIRM else read_count(msg)
+        logger.debug('User %s confirms %d message(s)', client.address, count)
+        for _ in range(min(count, len(client.in_flight))):
+            delivery = client.in_flight.popleft()
+            if delivery.expired:
+                # the message was already given to someone else
+                let_go(client, delivery)
+                continue
+            if delivery.timer is not None:
+                timer_wheel.cancel(delivery.timer)
+            confirm(client.receive_queue, delivery.message)
+    elif msg.type == MessageType.EXTEND:
+        # without a timeout the messages keep the one they were received with
+        replaced = msg.payload_size >= COUNT.size
+        timeout = read_timeout(msg, 0)
+        logger.debug('User %s extends the timeout of %d message(s)', client.address, len(client.in_flight))
+        for delivery in client.in_flight:
+            if delivery.expired:
+                continue
+            if delivery.timer is not None:
+                timer_wheel.cancel(delivery.timer)
+                delivery.timer = None
+            if replaced:
+                delivery.timeout = timeout
+            if delivery.timeout is not None:
+                delivery.timer = timer_wheel.schedule(delivery.timeout, expire, client, delivery)
+    else:
+        logger.warning('Received unknown packet of type %s from user %s', msg.type, client.address)
+
+
+async def admin(client: Server_Client, queue: Queue, request: dict):
+    """
+    Runs an admin command on the queue and answers with the result as json.
+    """
+    command = request.get('command') if isinstance(request, dict) else None
+    try:
+        if command == 'stats':
+            result = {
+                'queue': queue.name,
+                'depth': queue.message_queue.qsize(),
+                'delayed': len(queue.delayed),
+                'dead_letters': queue.dead_letter_queue.qsize(),
+                'consumers': len(queue.consumers),
+                'dead_letter_consumers': len(queue.dead_letter_consumers)
+            }
+        elif command == 'peek':
+            dead = bool(request.get('dead', False))
+            messages = (queue.dead_letter_queue if dead else queue.message_queue).peek(int(request.get('count', 10)))
+            result = {'messages': [{
+                'payload': base64.b64encode(decompress_payload(message)).decode(),
+                'retries': message.retries,
+                'priority': message.priority,
+                'deliver_at': message.deliver_at
+            } for message in messages]}
+        elif command == 'purge':
+            result = {'purged': await purge(queue, bool(request.get('dead', False)))}
+        elif command == 'replay':
+            result = {'replayed': await replay(queue, int(request.get('count', 0)), int(request.get('retries', 3)))}
+        else:
+            result = {'error': f'Unknown command {command!r}'}
+    except (MessageException, TypeError, ValueError) as e:
+        result = {'error': str(e)}
+    payload = json.dumps(result).encode()
+    client.send(Message(MessageType.ADMIN, payload_size=len(payload), payload=payload))
+
+
+async def purge(queue: Queue, dead: bool) -> int:
+    """
+    Removes all messages waiting in the queue, including the delayed ones, or
+    all messages of its dead letter queue. The messages are removed in
+    batches, so other clients are served meanwhile.
+    """
+    purged = 0
+    if not dead:
+        for message in queue.clear_delayed():
+            remove(queue, message)
+            purged += 1
+    source = queue.dead_letter_queue if dead else queue.message_queue
+    while not source.empty():
+        for _ in range(min(ADMIN_BATCH, source.qsize())):
+            remove(queue, source.get_nowait())
+            purged += 1
+        await asyncio.sleep(0)
+    PURGED.inc(purged)
+    if queue.blocked:
+        unblock(queue)
+    return purged
+
+
+async def replay(queue: Queue, count: int, retries: int) -> int:
+    """
+    Moves up to count dead letters, or all of them if count is 0, back to the
+    queue with a fresh retry counter. The messages are moved in batches, so
+    other clients are served meanwhile.
+    """
+    if count <= 0:
+        count = queue.dead_letter_queue.qsize()
+    retries = min(max(retries, 0), 255)
+    replayed = 0
+    while replayed < count and not queue.dead_letter_queue.empty():
+        for _ in range(min(ADMIN_BATCH, count - replayed, queue.dead_letter_queue.qsize())):
+            message = queue.dead_letter_queue.get_nowait()
+            message.retries = retries
+            message.attempts = 0
+            message.deliver_at = 0
+            queue.log(ENQUEUE, message)
+            message.enqueued_at = time.perf_counter()
+            queue.put(message)
+            replayed += 1
+        await asyncio.sleep(0)
+    REPLAYED.inc(replayed)
+    return replayed
+
+
+def throttle(client: Server_Client, queue: Queue, count: int, size: int):
+    """
+    Pauses a producer which exceeds its own or the global rate limit until
+    the limits allow more messages, which sent to a queue above the high
+    watermark until the queue is down to the low watermark, or which sends
+    while a standby doesn't keep up until it caught up.
+    """
+    if clients_closed is not None:
+        # the server stops, nothing would resume the producer
+        return
+    delay = 0.0
+    if client.limit is not None:
+        delay = client.limit.take(count, size)
+    if global_limit is not None:
+        delay = max(delay, global_limit.take(count, size))
+    if delay > 0 and client.throttle is None:
+        logger.debug('User %s exceeds the rate limit, pausing for %.3fs', client.address, delay)
+        client.throttle = loop.call_later(delay, unthrottle, client)
+        pause(client)
+    if HIGH_WATERMARK and client.blocked_by is None and queue.message_queue.qsize() >= HIGH_WATERMARK:
+        logger.debug('User %s is paused until queue %r is drained', client.address, queue.name)
+        client.blocked_by = queue
+        queue.blocked.add(client)
+        pause(client)
+    for replica in replicas:
+        if replica.behind and client.blocked_by is None:
+            logger.debug('User %s is paused until standby %s caught up', client.address, replica.client.address)
+            client.blocked_by = replica
+            replica.blocked.add(client)
+            pause(client)
+
+
+def unthrottle(client: Server_Client):
+    """
+    Resumes a producer paused by a rate limit, unless it is still in debt
+    because of messages received after it was paused.
+    """
+    client.throttle = None
+    delay = 0.0
+    if client.limit is not None:
+        delay = client.limit.take(0, 0)
+    if global_limit is not None:
+        delay = max(delay, global_limit.take(0, 0))
+    if delay > 0:
+        client.throttle = loop.call_later(delay, unthrottle, client)
+    else:
+        resume(client)
+
+
+def unblock(queue: Queue):
+    """
+    Resumes the producers paused by the high watermark of the queue once it
+    is down to the low watermark.
+    """
+    if queue.message_queue.qsize() > LOW_WATERMARK:
+        return
+    blocked, queue.blocked = queue.blocked, set()
+    for client in blocked:
+        client.blocked_by = None
+        resume(client)
+
+
+def pause(client: Server_Client):
+    if client.resumed is None:
+        PAUSED.inc()
+        client.resumed = loop.create_future()
+
+
+def unpause(client: Server_Client):
+    """
+    Resumes a paused producer no matter why he was paused.
+    """
+    if client.throttle is not None:
+        client.throttle.cancel()
+        client.throttle = None
+    if client.blocked_by is not None:
+        client.blocked_by.blocked.discard(client)
+        client.blocked_by = None
+    if client.draining is not None:
+        client.draining.cancel()
+        client.draining = None
+    resume(client)
+
+
+def resume(client: Server_Client):
+    if client.throttle is not None or client.blocked_by is not None or client.draining is not None or client.resumed is None:
+        return
+    resumed, client.resumed = client.resumed, None
+    resumed.set_result(None)
+
+
+def accept(client: Server_Client, queue: Queue):
+    """
+    Acknowledges a send package of the client once its messages are queued
+    or, with a write-ahead log, synced to disk.
+    """
+    client.sequence += 1
+    acknowledgement = Acknowledgement(client.sequence)
+    client.acks.append(acknowledgement)
+    if queue.wal is None:
+        acknowledge(client, acknowledgement)
+    else:
+        queue.wal.sync().add_done_callback(lambda future: synced(client, acknowledgement, future))
+
+
+def synced(client: Server_Client, acknowledgement: Acknowledgement, future: asyncio.Future):
+    if future.exception() is not None:
+        # the client must not believe the messages are safe
+        logger.error('User %s disconnected because: Write-ahead log sync failed (%r)', client.address, future.exception())
+        disconnect(client)
+    else:
+        acknowledge(client, acknowledgement)
 
 
-async def dead_letter_handler(message: Message, client: Server_Client):
-    client.message = message
-    await message.send(client.writer)
-    await client.message_event.wait()
-    if client.message is not None:
-        await dead_letter_queue.put(message)
+def acknowledge(client: Server_Client, acknowledgement: Acknowledgement):
+    """
+    Marks the send package as done. All done packages are acknowledged with
+    a single ACK package at the end of the loop iteration.
+    """
+    acknowledgement.done = True
+    if client.ack_handle is None and not client.disconnected:
+        client.ack_handle = loop.call_soon(send_acks, client)
+
+
+def send_acks(client: Server_Client):
+    client.ack_handle = None
+    acked = client.acked
+    while client.acks and client.acks[0].done:
+        acked = client.acks.popleft().sequence
+    if acked != client.acked:
+        client.acked = acked
+        client.send(ack_package(acked))
+
+
+def ack_package(sequence: int) -> Message:
+    payload = SEQUENCE.pack(sequence)
+    return Message(MessageType.ACK, payload_size=len(payload), payload=payload)
 
 
-async def dead_letter_queue_handler(loop, active: bool=True):
+def read_count(message: Message) -> int:
+    """
+    Reads the message count of a *_MANY package. A missing count is treated as 1.
+    """
+    if message.payload_size < COUNT.size:
+        return 1
+    return max(COUNT.unpack_from(message.payload)[0], 1)
+
+
+def read_timeout(message: Message, offset: int) -> float:
+    """
+    Reads the visibility timeout in milliseconds at offset of the payload
+    and returns it in seconds. Without a timeout the server default is used,
+    a timeout of 0 disables it.
+    """
+    if message.payload_size < offset + COUNT.size:
+        return VISIBILITY_TIMEOUT
+    timeout = COUNT.unpack_from(message.payload, offset)[0]
+    return timeout / 1000 if timeout > 0 else None
+
+
+def request_messages(client: Server_Client, count: int, dead: bool, timeout: float):
+    """
+    Adds count to the credit of the client and registers it as a waiting
+    consumer of its selected queue if it isn't already waiting.
+    """
+    queue = get_queue(client.queue_name)
+    client.timeout = timeout
+    client.dead = dead
+    client.receive_name = queue.name
+    client.receive_queue = queue
+    waiting = client.credit > 0
+    client.credit += count
+    if not waiting:
+        (queue.dead_letter_consumers if dead else queue.consumers).add(client)
+
+
+def forward(client: Server_Client, worker: int, name: str, message: Message):
+    """
+    Forwards a package to the worker owning the queue. The connection to the
+    worker is opened on first use, packages forwarded until it is open are
+    held back by the upstream.
+    """
+    upstream = client.upstreams.get(worker)
+    if upstream is None:
+        upstream = Upstream()
+        upstream.relay = asyncio.ensure_future(relay(upstream, client, worker))
+        client.upstreams[worker] = upstream
+        if client.codecs:
+            hello(upstream, client.codecs)
+        if client.acks is not None:
+            upstream.send(Message(MessageType.ACK))
+    if message.type not in RECEIVED_TYPES and upstream.queue_name != name:
+        payload = name.encode()
+        upstream.send(Message(MessageType.QUEUE, payload_size=len(payload), payload=payload))
+        upstream.queue_name = name
+    if client.acks is not None and message.type in (MessageType.SEND, MessageType.SEND_BATCH):
+        # the worker acknowledges the packages of the upstream on its own
+        client.sequence += 1
+        acknowledgement = Acknowledgement(client.sequence)
+        client.acks.append(acknowledgement)
+        upstream.sequence += 1
+        upstream.acks.append((upstream.sequence, acknowledgement))
+    upstream.send(message)
+    if message.type in (MessageType.SEND, MessageType.SEND_BATCH) and client.draining is None and upstream.full():
+        # the producer is paused like for a full queue until the worker
+        # read the forwarded packages
+        logger.debug('User %s is paused until worker %d caught up', client.address, worker)
+        client.draining = asyncio.ensure_future(drain_upstream(client, upstream))
+        pause(client)
+
+
+async def drain_upstream(client: Server_Client, upstream: Upstream):
+    """
+    Resumes a producer once the packages forwarded to a worker are written.
+    """
+    try:
+        await upstream.writer.drain()
+    except ConnectionError:
+        # the relay disconnects the client
+        pass
+    finally:
+        client.draining = None
+    resume(client)
+
+
+def subscribe(client: Server_Client):
+    """
+    Sends a snapshot of all live messages to a standby and then keeps sending
+    it every change. The snapshot holds the messages live at subscription in
+    their order, the changes made while it is streamed are sent after it.
+    """
+    snapshot = [(queue, list(queue.live)) for queue in queues.values()]
+    client.send(replication_package(REPLICATION_SNAPSHOT_BEGIN))
+    client.replica = Replica(client)
+    replicas.append(client.replica)
+    client.replica.snapshot = asyncio.ensure_future(stream_snapshot(client, snapshot))
+
+
+async def stream_snapshot(client: Server_Client, snapshot: list):
+    """
+    Sends the messages of the snapshot in batches and waits for the standby
+    to read each batch. A batch holds the current state of its messages, the
+    changes collected since are applied on top of it.
+    """
+    for queue, ids in snapshot:
+        data = []
+        size = 0
+        for index, id in enumerate(ids):
+            entry = queue.live.get(id)
+            if entry is not None:
+                record = encode_record(id, record_of(entry[1], entry[0]))
+                data.append(record)
+                size += len(record)
+            if data and (len(data) == ADMIN_BATCH or size >= SNAPSHOT_BATCH or index == len(ids) - 1):
+                client.send(replication_package(REPLICATION_RECORDS, queue.name, b''.join(data)))
+                data = []
+                size = 0
+                try:
+                    await client.writer.drain()
+                except ConnectionError:
+                    # the standby is disconnected by its handler
+                    return
+    client.send(replication_package(REPLICATION_SNAPSHOT_END))
+    client.replica.snapshot = None
+    client.replica.caught_up()
+
+
+def replication_package(kind: int, name: str=DEFAULT_QUEUE, data: bytes=b'') -> Message:
+    payload = REPLICATION.pack(kind, len(name.encode())) + name.encode() + data
+    return Message(MessageType.REPLICATE, payload_size=len(payload), payload=payload)
+
+
+async def follow(host: str, port: int, failover_timeout: float):
+    """
+    Mirrors the queues of the primary server until it was unreachable for
+    longer than failover_timeout after it was reached at least once.
+    """
+    reached = False
+    lost_at = time.monotonic()
+    while not reached or time.monotonic() - lost_at < failover_timeout:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), failover_timeout)
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(0.1)
+            continue
+        reached = True
+        logger.info('Following primary %s:%d', host, port)
+        writer.write(Message(MessageType.REPLICATE).encode())
+        snapshot = None
+        try:
+            while True:
+                message = await read_message(reader)
+                if message.type != MessageType.REPLICATE or message.payload_size < REPLICATION.size:
+                    raise MessageException('Unexpected package of the primary')
+                kind, length = REPLICATION.unpack_from(message.payload)
+                if kind == REPLICATION_SNAPSHOT_BEGIN:
+                    snapshot = {}
+                elif kind == REPLICATION_SNAPSHOT_END:
+                    drop_stale(snapshot or {})
+                    snapshot = None
+                else:
+                    name = message.payload[REPLICATION.size:REPLICATION.size + length].decode()
+                    ids = apply_records(get_queue(name), message.payload[REPLICATION.size + length:])
+                    if snapshot is not None:
+                        snapshot.setdefault(name, set()).update(ids)
+        except (EOFError, MessageException, OSError, UnicodeDecodeError) as e:
+            logger.warning('Lost primary %s:%d (%r)', host, port, e)
+        writer.close()
+        lost_at = time.monotonic()
+
+
+def apply_records(queue: Queue, data: bytes) -> list:
+    """
+    Applies the records replicated by the primary to the queue and returns
+    their ids. The messages are only put into the queues on promotion.
+    """
+    ids = []
+    end = 0
+    for end, id, record in read_records(data):
+        ids.append(id)
+        queue.next_id = max(queue.next_id, id + 1)
+        entry = queue.live.get(id)
+        if record.type == REMOVE:
+            if entry is not None:
+                remove(queue, entry[0])
+            continue
+        if entry is None:
+            message = Message(MessageType.SEND, record.retries, record.payload_size, record.payload, record.priority, record.deliver_at, record.compressed, record.message_id)
+            message.log_id = id
+            if spill is not None:
+                spill.store(message)
+        else:
+            message = entry[0]
+            message.retries = record.retries
+            message.priority = record.priority
+            message.deliver_at = record.deliver_at
+        queue.log(record.type, message)
+    if end != len(data):
+        raise MessageException('Invalid replication records')
+    return ids
+
+
+def drop_stale(snapshot: dict):
+    """
+    Removes the messages missing in a snapshot of the primary, they were
+    removed while the standby was not connected.
+    """
+    for queue in queues.values():
+        ids = snapshot.get(queue.name, ())
+        for id, (message, type) in list(queue.live.items()):
+            if id not in ids:
+                remove(queue, message)
+
+
+def promote():
+    """
+    Turns the standby into a primary by putting the mirrored messages into
+    their queues.
+    """
+    global STANDBY
+
+    STANDBY = False
+    for queue in queues.values():
+        queue.restore()
+    logger.info('Promoted to primary with %d messages', sum(len(queue.live) for queue in queues.values()))
+
+
+def hello(connection, codecs: bytes):
+    """
+    Sends a HELLO package with the given codecs to a client or upstream.
+    """
+    connection.send(Message(MessageType.HELLO, payload_size=len(codecs), payload=codecs))
+
+
+async def relay(upstream: Upstream, client: Server_Client, worker: int):
+    """
+    Connects the upstream to the worker and sends everything the worker
+    answers to the client, except the answers to the HELLO packages sent on
+    behalf of the client. The acknowledgements of the worker are turned into
+    acknowledgements of the client.
+    """
+    try:
+        for attempt in range(10):
+            try:
+                reader, writer = await asyncio.open_unix_connection(ipc_path(worker))
+                break
+            except (ConnectionError, FileNotFoundError):
+                # the worker may still be starting
+                if attempt == 9:
+                    raise
+                await asyncio.sleep(0.1)
+        upstream.connected(reader, writer)
+        while True:
+            message = await read_message(upstream.reader)
+            if message.type == MessageType.HELLO:
+                continue
+            if message.type == MessageType.ACK:
+                acked = SEQUENCE.unpack_from(message.payload)[0]
+                while upstream.acks and upstream.acks[0][0] <= acked:
+                    acknowledge(client, upstream.acks.popleft()[1])
+                continue
+            client.send(message)
+    except (EOFError, MessageException, OSError) as e:
+        # without the owning worker the client can't continue
+        logger.warning('User %s disconnected because: Worker %d is unreachable (%r)', client.address, worker, e)
+        disconnect(client)
+
+
+def hang_up(client: Server_Client):
+    """
+    Disconnects a client which closed the connection once the packages held
+    back from him are handled, the producer got no error for them.
+    """
+    client.closed = True
+    if not client.held:
+        disconnect(client)
+
+
+def disconnect(client: Server_Client):
+    """
+    Marks the client as disconnected and requeues all his unconfirmed messages.
+    """
+    if client.disconnected:
+        return
+    client.disconnected = True
+    client.credit = 0
+    client.writer.close()
+    if client.ack_handle is not None:
+        client.ack_handle.cancel()
+        client.ack_handle = None
+    client.held.clear()
+    client.held_size = 0
+    # lets a paused streams engine notice the disconnect
+    unpause(client)
+    if client.replica is not None:
+        client.replica.close()
+        replicas.remove(client.replica)
+        logger.info('Standby %s unsubscribed', client.address)
+    if client.receive_queue is not None:
+        (client.receive_queue.dead_letter_consumers if client.dead else client.receive_queue.consumers).discard(client)
+    for upstream in client.upstreams.values():
+        upstream.relay.cancel()
+        if upstream.writer is not None:
+            upstream.writer.close()
+    while client.in_flight:
+        delivery = client.in_flight.popleft()
+        if delivery.expired:
+            let_go(client, delivery)
+            continue
+        if delivery.timer is not None:
+            timer_wheel.cancel(delivery.timer)
+        fail(client, delivery.message)
+    clients.discard(client)
+    if not clients and clients_closed is not None and not clients_closed.done():
+        clients_closed.set_result(None)
+
+
+def expire(client: Server_Client, delivery: Delivery):
+    """
+    Gives a message back to its queue after its visibility timeout ran out.
+    The delivery stays in place, so later confirms still line up.
+    """
+    logger.info('Message of user %s timed out', client.address)
+    EXPIRED.inc()
+    delivery.expired = True
+    delivery.timer = None
+    # the client may still be working on the message, so it is not sent to
+    # the client again as long as the client holds the expired delivery
+    delivery.message.held_by = client
+    fail(client, delivery.message)
+
+
+def let_go(client: Server_Client, delivery: Delivery):
+    """
+    Forgets that the client holds the message of an expired delivery once
+    the client confirmed past it or disconnected.
+    """
+    if delivery.message.held_by is client:
+        delivery.message.held_by = None
+
+
+def dispatch(message: Message, client: Server_Client, consumers: ConsumerRegistry):
+    """
+    Sends the message to the consumer, unless the consumer still holds the
+    message since it expired there. The message then goes to the next waiting
+    consumer or, if there is none, back to the expired delivery, which starts
+    its visibility timeout again.
+    """
+    if message.held_by is client:
+        other = consumers.pop()
+        if other is not None:
+            consumers.add(client)
+            client = other
+        else:
+            for delivery in client.in_flight:
+                if delivery.expired and delivery.message is message:
+                    message.held_by = None
+                    delivery.expired = False
+                    if delivery.timeout is not None:
+                        delivery.timer = timer_wheel.schedule(delivery.timeout, expire, client, delivery)
+                    consumers.add(client)
+                    return
+    message_handler(message, client, consumers)
+
+
+def fail(client: Server_Client, message: Message):
+    """
+    Gives an unconfirmed message back to the queue it was received from.
+    """
+    if client.dead:
+        message.enqueued_at = time.perf_counter()
+        client.receive_queue.dead_letter_queue.put_nowait(message)
+    else:
+        requeue(client.receive_queue, message)
+
+
+def enqueue(queue: Queue, message: Message):
+    """
+    Puts a new message into the queue, unless it is a duplicate.
+    """
+    if dedup is not None and message.message_id is not None and not dedup.add(queue.name.encode(), message.message_id):
+        logger.debug('Dropped duplicate message %r of queue %r', message.message_id, queue.name)
+        DUPLICATES.inc()
+        return
+    start = time.perf_counter()
+    queue.log(ENQUEUE, message)
+    if spill is not None:
+        spill.store(message)
+    queue.put(message)
+    message.enqueued_at = time.perf_counter()
+    ENQUEUED.inc()
+    BYTES_IN.inc(message.payload_size)
+    ENQUEUE_LATENCY.observe(message.enqueued_at - start)
+
+
+def confirm(queue: Queue, message: Message):
+    """
+    Removes a message confirmed by a consumer.
+    """
+    CONFIRMED.inc()
+    CONFIRM_LATENCY.observe(time.perf_counter() - message.dispatched_at)
+    remove(queue, message)
+
+
+def remove(queue: Queue, message: Message):
+    """
+    Finally removes a confirmed or dropped message from the server.
+    """
+    queue.log(REMOVE, message)
+    if spill is not None:
+        spill.release(message)
+
+
+def requeue(queue: Queue, message: Message):
+    """
+    Puts a failed message back into the queue or, if it ran out of retries,
+    into the dead letter queue. With a retry backoff the message is delayed
+    twice as long with every attempt.
+    """
+    message.enqueued_at = time.perf_counter()
+    if message.retries == 0:
+        if not NDLQ:
+            DEAD_LETTERED.inc()
+            queue.log(DEAD, message)
+            queue.dead_letter_queue.put_nowait(message)
+        else:
+            DROPPED.inc()
+            remove(queue, message)
+    else:
+        REQUEUED.inc()
+        message.attempts = message.attempts + 1
+        if RETRY_BACKOFF:
+            backoff = min(RETRY_BACKOFF * 2 ** min(message.attempts - 1, 32), RETRY_BACKOFF_MAX)
+            message.deliver_at = int(time.time() * 1000 + backoff)
+        if message.retries != 255:
+            message.retries -= 1
+            queue.log(ENQUEUE, message)
+        queue.put(message)
+
+
+def message_handler(message: Message, client: Server_Client, consumers: ConsumerRegistry):
+    message.dispatched_at = time.perf_counter()
+    DISPATCHED.inc()
+    BYTES_OUT.inc(message.payload_size)
+    DISPATCH_LATENCY.observe(message.dispatched_at - message.enqueued_at)
+    delivery = Delivery(message, client.timeout)
+    if delivery.timeout is not None:
+        delivery.timer = timer_wheel.schedule(delivery.timeout, expire, client, delivery)
+    client.in_flight.append(delivery)
+    client.credit -= 1
+    if client.credit > 0:
+        consumers.add(client)
+    if message.compressed and message.payload[0] not in client.codecs:
+        # the payload is kept compressed, only clients without the codec get
+        # a decompressed copy
+        try:
+            payload = decompress_payload(message)
+            message = Message(message.type, message.retries, len(payload), payload, message.priority, message.deliver_at, message_id=message.message_id)
+        except MessageException as e:
+            logger.warning('Message for user %s can\'t be decompressed: %s', client.address, e)
+    client.send(message)
+
+
+async def queue_handler(queue: Queue, loop):
+    while True:
+        # wait for a consumer first, so a message arriving meanwhile with a
+        # higher priority is not stuck behind the one taken from the queue
+        await queue.consumers.wait()
+        msg = await queue.message_queue.get()
+        if queue.blocked:
+            unblock(queue)
+        client = await queue.consumers.get()
+        dispatch(msg, client, queue.consumers)
+
+
+async def dead_letter_queue_handler(queue: Queue, loop, active: bool=True):
     while True:
         if active:
-            msg = await dead_letter_queue.get()
-            client = await dead_letter_client_queue.get()
-            while client.disconnected:
-                client = await dead_letter_client_queue.get()
-            asyncio.ensure_future(dead_letter_handler(msg, client), loop=loop)
+            # like the queue_handler, so dead letters can still be inspected
+            # while no consumer waits for them
+            await queue.dead_letter_consumers.wait()
+            msg = await queue.dead_letter_queue.get()
+            client = await queue.dead_letter_consumers.get()
+            dispatch(msg, client, queue.dead_letter_consumers)
         else:
-            client = await dead_letter_client_queue.get()
-            await Message(type=MessageType.NO_RECEIVE).send(client.writer)
+            client = await queue.dead_letter_consumers.get()
+            client.credit = 0
+            client.send(Message(type=MessageType.NO_RECEIVE))
 
 
+def parse_log_level(string: str) -> int:
+    try:
+        return LOG_LEVELS[string.lower()]
+    except KeyError:
+        raise ArgumentTypeError(string + ' is NOT a valid loglevel')
 
-# Entry Point
-if __name__ == "__main__":
-    # Setup argparse
+
+def parse_address(string: str) -> (str, int):
+    host, _, port = string.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise ArgumentTypeError(string + ' is NOT a valid address, use host:port')
+
+
+def setup_logging(level: int) -> QueueListener:
+    """
+    Sends all log records through a queue to a background thread, so writing
+    them to stdout never blocks the event loop.
+    """
+    records = SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = QueueListener(records, handler)
+    listener.start()
+    logger.addHandler(QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    return listener
+
+
+def watch_parent(loop, parent: int):
+    """
+    Stops the loop of a worker as soon as the parent process is gone, so no
+    orphaned workers keep the port open.
+    """
+    if os.getppid() != parent:
+        loop.stop()
+    else:
+        loop.call_later(1, watch_parent, loop, parent)
+
+
+def build_parser() -> ArgumentParser:
+    """
+    Returns the parser of the command line arguments. Its defaults are also
+    the defaults of the options of SSPQServer.
+    """
     parser = ArgumentParser(description='SSPQ Server - Super Simple Python Queue Server', add_help=True)
     parser.add_argument('--host', action='store', default='127.0.0.1', required=False, help='Set the host address. Use 0.0.0.0 to make the server public', dest='host', metavar='<address>')
     parser.add_argument('-p', '--port', action='store', default=SSPQ_PORT, type=int, required=False, help='Set the port the server listens to', dest='port', metavar='<port>')
-    parser.add_argument('-ll', '--loglevel', action='store', default='info', type=LogLevel.parse, choices=[
-        LogLevel.FAIL, LogLevel.WARN, LogLevel.INFO, LogLevel.DBUG
-    ], required=False, help='Set the appropriate log level for the output on stdout. Possible values are: [ fail | warn | info | dbug ]', dest='log_level', metavar='<level>')
+    parser.add_argument('-ll', '--loglevel', action='store', default='info', type=parse_log_level, choices=list(LOG_LEVELS.values()), required=False, help='Set the appropriate log level for the output on stdout. Possible values are: [ fail | warn | info | dbug ]', dest='log_level', metavar='<level>')
     parser.add_argument('-ndlq', '--no-dead-letter-queue', action='store_true', required=False, help='Flag to dissable the dead letter queueing, failed packages are then simply dropped after the retries run out.', dest='ndlq')
     parser.add_argument('-r', '--force-retries', action='store', type=int, choices=range(0, 256), required=False, help='This overrides the retry values of all incoming packets to the given value. Values between 0 and 254 are possible retry values if 255 is used all packages are infinitely retried.', dest='retry', metavar='[0-255]')
+    parser.add_argument('--retry-backoff', action='store', default=0, type=int, required=False, help='Delay requeued messages by this many milliseconds, doubled with every further attempt. Disabled by default.', dest='retry_backoff', metavar='<ms>')
+    parser.add_argument('--retry-backoff-max', action='store', default=60000, type=int, required=False, help='Set the maximum delay of a requeued message in milliseconds', dest='retry_backoff_max', metavar='<ms>')
+    parser.add_argument('-vt', '--visibility-timeout', action='store', default=None, type=float, required=False, help='Set the seconds a consumer has to confirm a message before it is requeued. Consumers can override this per receive and extend it while working on a message. By default messages are only requeued when the consumer disconnects.', dest='visibility_timeout', metavar='<seconds>')
+    parser.add_argument('--wal', action='store', default=None, required=False, help='Persist the queues in an append-only log in the given directory and recover them from it on startup.', dest='wal', metavar='<directory>')
+    parser.add_argument('--wal-sync-interval', action='store', default=5, type=int, required=False, help='Set the time in milliseconds writes to the log are collected before they are synced to disk together.', dest='wal_sync_interval', metavar='<ms>')
+    parser.add_argument('--wal-segment-size', action='store', default=64, type=int, required=False, help='Set the size in MiB after which a new log segment is started.', dest='wal_segment_size', metavar='<MiB>')
+    parser.add_argument('--memory-limit', action='store', default=None, type=int, required=False, help='Set the amount of MiB queued payloads may use in memory. Payloads beyond this limit are spilled to memory-mapped files.', dest='memory_limit', metavar='<MiB>')
+    parser.add_argument('--spill-dir', action='store', default=None, required=False, help='Set the directory for spilled payloads. Defaults to the systems temp directory.', dest='spill_dir', metavar='<directory>')
+    parser.add_argument('--rate-limit', action='store', default=None, type=float, required=False, help='Set the messages per second a single connection may send. The messages of a connection above the limit are held back and reading from it is paused, so the producer is slowed down by TCP. Disabled by default.', dest='rate_limit', metavar='<msgs/s>')
+    parser.add_argument('--byte-rate-limit', action='store', default=None, type=float, required=False, help='Set the payload KiB per second a single connection may send. Disabled by default.', dest='byte_rate_limit', metavar='<KiB/s>')
+    parser.add_argument('--global-rate-limit', action='store', default=None, type=float, required=False, help='Set the messages per second all connections together may send. The limit is shared between the workers. Disabled by default.', dest='global_rate_limit', metavar='<msgs/s>')
+    parser.add_argument('--global-byte-rate-limit', action='store', default=None, type=float, required=False, help='Set the payload KiB per second all connections together may send. The limit is shared between the workers. Disabled by default.', dest='global_byte_rate_limit', metavar='<KiB/s>')
+    parser.add_argument('--high-watermark', action='store', default=None, type=int, required=False, help='Hold back the messages of producers of a queue with this many waiting messages until the queue is down to the low watermark. Disabled by default.', dest='high_watermark', metavar='<messages>')
+    parser.add_argument('--low-watermark', action='store', default=None, type=int, required=False, help='Set the waiting messages of a queue below which its paused producers are resumed. Defaults to half the high watermark.', dest='low_watermark', metavar='<messages>')
+    parser.add_argument('--dedup-window', action='store', default=None, type=float, required=False, help='Drop messages sent to a queue within this many seconds after another message with the same message id. Disabled by default.', dest='dedup_window', metavar='<seconds>')
+    parser.add_argument('--dedup-size', action='store', default=1000000, type=int, required=False, help='Set the number of message ids remembered for the deduplication at most. The oldest ids are forgotten early once there are more. The ids are shared between the workers.', dest='dedup_size', metavar='<ids>')
+    parser.add_argument('--metrics-port', action='store', default=None, type=int, required=False, help='Serve metrics in the prometheus text format over http on the given port. With multiple workers each worker uses the next port.', dest='metrics_port', metavar='<port>')
+    parser.add_argument('--engine', action='store', default='streams', choices=['streams', 'protocol'], required=False, help='Set the server engine. The streams engine runs a coroutine per connection, the protocol engine handles the packages in callbacks of the transport and holds many idle connections more cheaply. Possible values are: [ streams | protocol ]', dest='engine', metavar='<engine>')
+    parser.add_argument('--uvloop', action='store_true', required=False, help='Flag to run the server on uvloop, which has to be installed.', dest='uvloop')
+    parser.add_argument('--standby-of', action='store', default=None, type=parse_address, required=False, help='Run as hot standby of the primary server at the given address. The standby mirrors the queues of the primary and only accepts clients once the primary is unreachable for longer than the failover timeout.', dest='standby_of', metavar='<host:port>')
+    parser.add_argument('--failover-timeout', action='store', default=3.0, type=float, required=False, help='Set the seconds a standby waits for a lost primary before it takes over.', dest='failover_timeout', metavar='<seconds>')
+    parser.add_argument('-w', '--workers', action='store', default=1, type=int, required=False, help='Set the number of worker processes. The queues are distributed over the workers and packages for a queue of another worker are forwarded to it. The memory limit is shared between the workers.', dest='workers', metavar='<count>')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s v1.0.0')
-    args = parser.parse_args()
+    return parser
+
+
+def check_arguments(args):
+    """
+    Raises a ValueError if the arguments don't fit together.
+    """
+    if args.dedup_size < 1:
+        raise ValueError('The deduplication needs to remember at least 1 id')
+    if any(limit is not None and limit <= 0 for limit in (args.rate_limit, args.byte_rate_limit, args.global_rate_limit, args.global_byte_rate_limit, args.high_watermark)):
+        raise ValueError('Rate limits and the high watermark need to be positive')
+    if args.high_watermark is not None and args.low_watermark is not None and args.low_watermark >= args.high_watermark:
+        raise ValueError('The low watermark needs to be below the high watermark')
+    if args.standby_of is not None and args.workers > 1:
+        raise ValueError('A standby can only run with a single worker')
+
+
+def configure(args, worker: int=0, workers: int=1, ipc_dir: str=None):
+    """
+    Sets up the state of the server, or one of its workers, on the current
+    event loop and recovers the queues from the write-ahead log.
+    """
+    global NDLQ, RETRY_BACKOFF, RETRY_BACKOFF_MAX, VISIBILITY_TIMEOUT, WAL_DIR, WAL_OPTIONS, WORKER, WORKERS, IPC_DIR, STANDBY, CLIENT_LIMIT, HIGH_WATERMARK, LOW_WATERMARK, loop, spill, timer_wheel, global_limit, dedup, queues, replicas, clients, clients_closed
 
     NDLQ = args.ndlq
+    RETRY_BACKOFF = args.retry_backoff
+    RETRY_BACKOFF_MAX = args.retry_backoff_max
+    VISIBILITY_TIMEOUT = args.visibility_timeout if args.visibility_timeout else None
+    WAL_DIR = args.wal
+    WAL_OPTIONS = {'segment_size': args.wal_segment_size * 1024 * 1024, 'sync_interval': args.wal_sync_interval / 1000}
+    WORKER = worker
+    WORKERS = workers
+    IPC_DIR = ipc_dir
+    STANDBY = args.standby_of is not None
+    CLIENT_LIMIT = None
+    if args.rate_limit or args.byte_rate_limit:
+        CLIENT_LIMIT = (args.rate_limit, args.byte_rate_limit * 1024 if args.byte_rate_limit else None)
+    HIGH_WATERMARK = args.high_watermark
+    LOW_WATERMARK = args.low_watermark if args.low_watermark is not None else (args.high_watermark or 0) // 2
+
+    loop = asyncio.get_event_loop()
+    timer_wheel = TimerWheel()
+    spill = None
+    if args.memory_limit is not None:
+        spill = SpillStore(args.memory_limit * 1024 * 1024 // workers, directory=args.spill_dir)
+    dedup = None
+    if args.dedup_window:
+        dedup = DedupIndex(args.dedup_window, max(args.dedup_size // workers, 1))
+    global_limit = None
+    if args.global_rate_limit or args.global_byte_rate_limit:
+        global_limit = RateLimit(args.global_rate_limit / workers if args.global_rate_limit else None, args.global_byte_rate_limit * 1024 / workers if args.global_byte_rate_limit else None)
+    queues = {}
+    replicas = []
+    clients = set()
+    clients_closed = None
+    if shard_of(DEFAULT_QUEUE) == WORKER:
+        get_queue(DEFAULT_QUEUE)
+    if WAL_DIR is not None:
+        os.makedirs(WAL_DIR, exist_ok=True)
+        for name in os.listdir(WAL_DIR):
+            if name.startswith(WAL_QUEUE_PREFIX):
+                queue_name = bytes.fromhex(name[len(WAL_QUEUE_PREFIX):]).decode()
+                if shard_of(queue_name) == WORKER:
+                    get_queue(queue_name)
+
+
+async def listen(args, worker: int=0, workers: int=1) -> (asyncio.AbstractServer, asyncio.AbstractServer):
+    """
+    Starts accepting clients on the host and port of the arguments and, with
+    multiple workers, on the unix socket of the worker. Returns both servers,
+    the second one is None with a single worker.
+    """
+    ipc_server = None
+    if args.engine == 'protocol':
+        protocol = lambda: ServerProtocol(retry_override=args.retry)
+        server = await loop.create_server(protocol, args.host, args.port, reuse_port=(workers > 1))
+        if workers > 1:
+            ipc_server = await loop.create_unix_server(protocol, ipc_path(worker))
+    else:
+        handler = get_user_handler(retry_override=args.retry)
+        server = await asyncio.start_server(handler, args.host, args.port, reuse_port=(workers > 1))
+        if workers > 1:
+            ipc_server = await asyncio.start_unix_server(handler, ipc_path(worker))
+    return server, ipc_server
+
+
+def serve(args, worker: int=0, workers: int=1, ipc_dir: str=None):
+    """
+    Runs the server, or one of its workers, until Ctrl+C is pressed.
+    """
+    listener = setup_logging(args.log_level)
 
     # Setup asyncio & queues
+    if args.uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     loop = asyncio.get_event_loop()
-    message_queue = asyncio.Queue()
-    client_queue = asyncio.Queue()
-    dead_letter_queue = asyncio.Queue()
-    dead_letter_client_queue = asyncio.Queue()
-    coro = asyncio.start_server(get_user_handler(log_level=args.log_level, retry_override=args.retry), args.host, args.port, loop=loop)
-    server = loop.run_until_complete(coro)
-    queue_worker = asyncio.ensure_future(queue_handler(loop=loop), loop=loop)
-    dead_letter_queue_worker = asyncio.ensure_future(dead_letter_queue_handler(loop=loop, active=(not args.ndlq)), loop=loop)
+    configure(args, worker, workers, ipc_dir)
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = loop.run_until_complete(start_metrics_server(args.host, args.metrics_port + worker))
+        logger.info('Serving metrics on %s', metrics_server.sockets[0].getsockname())
+
+    # A standby only accepts clients once the primary is gone
+    if STANDBY:
+        following = asyncio.ensure_future(follow(args.standby_of[0], args.standby_of[1], args.failover_timeout), loop=loop)
+        try:
+            loop.run_until_complete(following)
+        except KeyboardInterrupt:
+            following.cancel()
+            shutdown(loop, [metrics_server])
+            listener.stop()
+            return
+        promote()
+
+    server, ipc_server = loop.run_until_complete(listen(args, worker, workers))
+    if workers > 1:
+        watch_parent(loop, os.getppid())
 
     # Serve requests until Ctrl+C is pressed
-    print(f'Serving on {server.sockets[0].getsockname()}')
+    if workers > 1:
+        logger.info('Worker %d serving on %s', worker, server.sockets[0].getsockname())
+    else:
+        logger.info('Serving on %s', server.sockets[0].getsockname())
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
-    # Close the server
-    server.close()
-    queue_worker.cancel()
-    dead_letter_queue_worker.cancel()
-    loop.run_until_complete(server.wait_closed())
+    shutdown(loop, [server, ipc_server, metrics_server])
+    listener.stop()
+
+
+async def close(servers: list):
+    """
+    Closes the given servers and the connections of all clients and stops all
+    queues. The packages received from a client before are handled and his
+    unconfirmed messages are requeued before the queues stop.
+    """
+    global clients_closed
+
+    servers = [server for server in servers if server is not None]
+    for server in servers:
+        server.close()
+    # let the handlers of just accepted connections start
+    await asyncio.sleep(0)
+    clients_closed = loop.create_future()
+    for client in list(clients):
+        client.writer.close()
+        # the packages held back from paused producers are queued, so
+        # nothing the clients sent before is lost
+        unpause(client)
+    if clients:
+        try:
+            await asyncio.wait_for(clients_closed, CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # the clients didn't read what was still sent to them
+            for client in list(clients):
+                client.writer.transport.abort()
+                disconnect(client)
+        clients_closed = None
+    for queue in queues.values():
+        queue.stop()
+    timer_wheel.close()
+    for server in servers:
+        await server.wait_closed()
+    # let the cancelled tasks finish
+    await asyncio.sleep(0)
+
+
+def shutdown(loop, servers: list):
+    """
+    Closes the given servers, stops all queues and closes the loop.
+    """
+    loop.run_until_complete(close(servers))
     loop.close()
+
+
+class SSPQServer():
+    """
+    This runs the server on the event loop of an application, e.g. of a test
+    suite. The options are named like the parsed command line arguments, e.g.
+    visibility_timeout, wal or retry for --force-retries, and have the same
+    defaults. With port 0 the server listens on a free port, with port None
+    it doesn't listen at all and is only reachable with connect, which needs
+    no socket. Logging is left to the application.
+
+    The state of the server is global to this module, so only one server can
+    run in a process at a time.
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=0, **options):
+        defaults = vars(build_parser().parse_args([]))
+        unknown = sorted(set(options) - set(defaults))
+        if unknown:
+            raise TypeError('Unknown server options: ' + ', '.join(unknown))
+        if options.get('workers', 1) != 1:
+            raise ValueError('An embedded server can only run with a single worker')
+        if options.get('standby_of') is not None:
+            raise ValueError('An embedded server can not run as standby')
+        defaults.update(options, host=host, port=port)
+        self.args = Namespace(**defaults)
+        check_arguments(self.args)
+        self.server = None
+        self.metrics_server = None
+        self.handler = None
+        # the handlers of the in-process connections with the streams engine
+        self.tasks = set()
+
+    @property
+    def port(self) -> int:
+        """
+        The port the server listens on, e.g. the one chosen for port 0.
+        """
+        if self.server is None:
+            return None
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        """
+        Recovers the queues and starts accepting clients.
+        """
+        global embedded
+        if embedded is not None:
+            raise ServerStateException('Another server is already running in this process!')
+        embedded = self
+        try:
+            configure(self.args)
+        except BaseException:
+            embedded = None
+            raise
+        self.handler = get_user_handler(retry_override=self.args.retry)
+        try:
+            if self.args.port is not None:
+                self.server, _ = await listen(self.args)
+            if self.args.metrics_port is not None:
+                self.metrics_server = await start_metrics_server(self.args.host, self.args.metrics_port)
+        except BaseException:
+            await self.stop()
+            raise
+
+    async def stop(self) -> None:
+        """
+        Stops accepting clients, disconnects all clients and stops all
+        queues. The packages the clients sent before are handled and the
+        unconfirmed messages are requeued before the write-ahead log is
+        closed.
+        """
+        global embedded
+        if embedded is not self:
+            return
+        await close([self.server, self.metrics_server])
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.server = None
+        self.metrics_server = None
+        embedded = None
+
+    async def connect(self, compression: bool=False, confirms: bool=False, window: int=1000) -> Client:
+        """
+        Returns a client connected to the server without a socket. See
+        Client.connect for the arguments.
+        """
+        if embedded is not self:
+            raise ServerStateException('Need to start the server first!')
+        reader, writer = connect_in_process(self._protocol(), loop=loop)
+        client = Client()
+        await client.connect(connection=(reader, writer), compression=compression, confirms=confirms, window=window)
+        return client
+
+    def _protocol(self) -> asyncio.Protocol:
+        if self.args.engine == 'protocol':
+            return ServerProtocol(retry_override=self.args.retry)
+        return asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), self._connected, loop=loop)
+
+    def _connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.ensure_future(self.handler(reader, writer), loop=loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.stop()
+
+
+
+# Entry Point
+if __name__ == "__main__":
+    import importlib.util
+    import multiprocessing
+    import shutil
+    import signal
+    import socket
+    import tempfile
+
+    # Setup argparse
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.uvloop and importlib.util.find_spec('uvloop') is None:
+        parser.error('uvloop is not installed')
+    try:
+        check_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('Multiple workers need SO_REUSEPORT which is not supported on this platform')
+        # every worker accepts connections on the same port and owns a share of
+        # the queues, packages for other queues are forwarded via unix sockets
+        ipc_dir = tempfile.mkdtemp(prefix='sspq-')
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=serve, args=(args, worker, args.workers, ipc_dir), daemon=True) for worker in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: os.kill(os.getpid(), signal.SIGINT))
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                if worker.is_alive():
+                    os.kill(worker.pid, signal.SIGINT)
+            for worker in workers:
+                worker.join()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+    else:
+        serve(args)
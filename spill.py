@@ -0,0 +1,92 @@
+"""
+This keeps the memory used by queued payloads of the sspq server below a
+configured budget. Payloads which don't fit into the budget anymore are
+written to memory-mapped segment files and the message keeps a memoryview of
+the mapping instead of the payload, so it can be sent without reading the file
+back and the operating system can page it out whenever memory is needed.
+"""
+import mmap
+import os
+import tempfile
+from sspq import *
+
+
+__all__ = [
+    'SpillStore'
+]
+
+
+
+#
+# --- Classes ---
+#
+class SpillSegment():
+    """
+    This is a memory-mapped segment file holding spilled payloads.
+    """
+    def __init__(self, directory: str, size: int):
+        fd, path = tempfile.mkstemp(prefix='spill-', suffix='.seg', dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            # the mapping stays valid, the space is freed with the last view
+            os.close(fd)
+            os.remove(path)
+        self.size = size
+        self.offset = 0
+        self.live = 0
+
+
+class SpillStore():
+    """
+    This accounts the payloads of queued messages against the memory limit
+    and spills them to segment files once the limit is reached.
+    """
+    def __init__(self, memory_limit: int, directory: str=None, segment_size: int=64 * 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.directory = directory if directory is not None else tempfile.gettempdir()
+        self.segment_size = segment_size
+        self.memory_used = 0
+        self.spilled = 0
+        self.segment = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def store(self, message: Message) -> None:
+        """
+        This has to be called when a message enters the queues. The payload is
+        either accounted against the memory limit or spilled to disk.
+        """
+        if message.spill_segment is not None:
+            return
+        if self.memory_used + message.payload_size <= self.memory_limit or message.payload_size == 0:
+            message.spill_segment = None
+            self.memory_used += message.payload_size
+            return
+
+        segment = self.segment
+        if segment is None or segment.size - segment.offset < message.payload_size:
+            segment = SpillSegment(self.directory, max(self.segment_size, message.payload_size))
+            self.segment = segment
+        end = segment.offset + message.payload_size
+        segment.map[segment.offset:end] = message.payload
+        message.payload = memoryview(segment.map)[segment.offset:end]
+        message.spill_segment = segment
+        segment.offset = end
+        segment.live += 1
+        self.spilled += message.payload_size
+
+    def release(self, message: Message) -> None:
+        """
+        This has to be called when a message finally leaves the queues.
+        """
+        segment = message.spill_segment
+        if segment is None:
+            self.memory_used -= message.payload_size
+            return
+        message.spill_segment = None
+        segment.live -= 1
+        self.spilled -= message.payload_size
+        if segment.live == 0 and segment is self.segment:
+            # nothing references the segment anymore, so it can be refilled
+            segment.offset = 0
@@ -4,19 +4,52 @@ queue connection. The code here is all asyncio based and can't really be run
 without a propper event loop.
 """
 import asyncio
+import base64
+import concurrent.futures
+import itertools
+import json
+import struct
+import threading
+import time
+import warnings
+import zlib
+from collections import deque
 from enum import Enum
 
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
 
 __all__ = [
     'Client',
+    'ClientPool',
     'ClientStateException',
+    'CODECS',
+    'compress_message',
+    'COUNT',
+    'decode_batch',
+    'decompress_payload',
+    'DEFAULT_QUEUE',
+    'encode_batch',
+    'FLAG_COMPRESSED',
+    'FLAG_ID',
+    'FLAG_PROPERTIES',
+    'FrameWriter',
+    'HEADER',
     'MAGIC_VALUE',
     'MessageType',
     'MessageException',
     'Message',
+    'PoolMessage',
+    'PROPERTIES',
     'read_message',
     'ServerStateException',
-    'SSPQ_PORT'
+    'SEQUENCE',
+    'SIZE_MASK',
+    'SSPQ_PORT',
+    'SyncClient'
 ]
 
 
@@ -26,6 +59,39 @@ __all__ = [
 #
 MAGIC_VALUE = b'\x55\x99'
 SSPQ_PORT = 8888
+DEFAULT_QUEUE = ''
+
+# magic value, package type, retry counter, payload size
+HEADER = struct.Struct('!2scBI')
+# payload of the *_MANY packages
+COUNT = struct.Struct('!I')
+# payload of the ACK packages, the number of acknowledged send packages
+SEQUENCE = struct.Struct('!Q')
+
+# the upper bits of the payload size are flags, the rest is the actual size
+FLAG_COMPRESSED = 0x80000000
+FLAG_PROPERTIES = 0x40000000
+FLAG_ID = 0x20000000
+SIZE_MASK = 0x1fffffff
+# priority, deliver at (milliseconds since the epoch)
+PROPERTIES = struct.Struct('!BQ')
+
+# compression codecs by the id the compressed payload starts with
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODECS = {
+    CODEC_ZLIB: (lambda data: zlib.compress(data, 1), zlib.decompress)
+}
+if lz4_frame is not None:
+    CODECS[CODEC_LZ4] = (lz4_frame.compress, lz4_frame.decompress)
+# the faster codecs first
+CODEC_PREFERENCE = (CODEC_LZ4, CODEC_ZLIB)
+# smaller payloads are never compressed
+COMPRESSION_THRESHOLD = 512
+
+# the event loop thread shared by all SyncClients
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
 
 
 
@@ -39,14 +105,26 @@ class MessageType(Enum):
     DEAD_RECEIVE = b'\xde'
     NO_RECEIVE = b'\x0e'
 
+    SEND_BATCH = b'\x5b'
+    RECEIVE_MANY = b'\xe3'
+    CONFIRM_MANY = b'\xc3'
+    DEAD_RECEIVE_MANY = b'\xd3'
+
+    QUEUE = b'\x51'
+    EXTEND = b'\xe7'
+    HELLO = b'\x48'
+    ADMIN = b'\xad'
+    REPLICATE = b'\x52'
+    ACK = b'\xac'
+
     OTHER = b'\xff'
 
     @classmethod
     def get(cls, value: bytes) -> super:
-        try:
-            return cls(value)
-        except ValueError:
-            return cls.OTHER
+        return _MESSAGE_TYPES.get(value, cls.OTHER)
+
+
+_MESSAGE_TYPES = {type.value: type for type in MessageType}
 
 
 
@@ -84,66 +162,390 @@ class ClientStateException(Exception):
 #
 class Message():
     """
-    This is a message which is sent via a sspq server.
+    This is a message which is sent via a sspq server. Messages with a higher
+    priority are delivered first, a message with deliver_at set is not
+    delivered before that time in milliseconds since the epoch. The payload of
+    a compressed message starts with the id of its codec. The optional message
+    id lets the server drop messages which are sent twice.
     """
-    def __init__(self, type: MessageType, retries: int = 0, payload_size: int = 0, payload: bytes = b''):
+    # the server keeps its bookkeeping of queued messages in the last slots
+    __slots__ = ('type', 'retries', 'payload_size', 'payload', 'priority', 'deliver_at', 'compressed', 'message_id', 'log_id', 'spill_segment', 'enqueued_at', 'dispatched_at', 'attempts', 'held_by')
+
+    def __init__(self, type: MessageType, retries: int = 0, payload_size: int = 0, payload: bytes = b'', priority: int = 0, deliver_at: int = 0, compressed: bool = False, message_id: bytes = None):
         self.type = type
         self.retries = retries
         self.payload_size = payload_size
         self.payload = payload
+        self.priority = priority
+        self.deliver_at = deliver_at
+        self.compressed = compressed
+        self.message_id = message_id
+        self.log_id = None
+        self.spill_segment = None
+        self.enqueued_at = 0.0
+        self.dispatched_at = 0.0
+        self.attempts = 0
+        self.held_by = None
+
+    @classmethod
+    def decode(cls, _type: bytes, retries: int, size: int, data: bytes) -> 'Message':
+        """
+        This creates a message from the fields of a header and the data
+        following it, which is (size & SIZE_MASK) bytes long.
+        """
+        compressed = bool(size & FLAG_COMPRESSED)
+        if not size & (FLAG_PROPERTIES | FLAG_ID):
+            return cls(MessageType.get(_type), retries, size & SIZE_MASK, data, compressed=compressed)
+        priority, deliver_at, message_id = 0, 0, None
+        offset = 0
+        if size & FLAG_PROPERTIES:
+            if len(data) < PROPERTIES.size:
+                raise MessageException('Incomplete message properties')
+            priority, deliver_at = PROPERTIES.unpack_from(data)
+            offset = PROPERTIES.size
+        if size & FLAG_ID:
+            if len(data) < offset + 1 or len(data) < offset + 1 + data[offset]:
+                raise MessageException('Incomplete message id')
+            message_id = data[offset + 1:offset + 1 + data[offset]]
+            offset += 1 + data[offset]
+        payload = data[offset:]
+        return cls(MessageType.get(_type), retries, len(payload), payload, priority, deliver_at, compressed, message_id)
+
+    def frame(self) -> list:
+        """
+        This returns the encoded message as a list of the header and the
+        payload, so the payload is never copied just to put a header in front
+        of it. The properties and the message id are only added if they are
+        set.
+        """
+        flags = FLAG_COMPRESSED if self.compressed else 0
+        extra = b''
+        if self.priority or self.deliver_at:
+            flags |= FLAG_PROPERTIES
+            extra = PROPERTIES.pack(self.priority, self.deliver_at)
+        if self.message_id is not None:
+            flags |= FLAG_ID
+            extra += bytes((len(self.message_id),)) + self.message_id
+        header = HEADER.pack(MAGIC_VALUE, self.type.value, self.retries, (len(extra) + self.payload_size) | flags) + extra
+        return [header, self.payload] if self.payload_size > 0 else [header]
 
     def encode(self) -> bytes:
         """
         This encodes the message as a bytes object to be sent over the network
         or write to disk.
         """
-        return MAGIC_VALUE + \
-            self.type.value + \
-            self.retries.to_bytes(1, 'big', signed=False) + \
-            self.payload_size.to_bytes(4, 'big', signed=False) + \
-            self.payload
+        return b''.join(self.frame())
 
     async def send(self, writer: asyncio.StreamWriter) -> None:
         """
-        This sends the message via the given asyncio StreamWriter.
+        This sends the message via the given asyncio StreamWriter or
+        FrameWriter.
         """
-        writer.write(self.encode())
+        writer.writelines(self.frame())
         await writer.drain()
 
 
+class FrameWriter():
+    """
+    This wraps a asyncio.StreamWriter or a transport and collects everything
+    written to it during one iteration of the event loop, which is then
+    handed to the transport with a single writelines call. drain only waits
+    for the transport once more than its high-water mark is buffered, so
+    sending many small messages doesn't wait for each of them. A protocol
+    writing to a transport directly has to pass on pause_writing and
+    resume_writing for drain to wait.
+    """
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.transport = getattr(writer, 'transport', writer)
+        self.buffers = []
+        self.size = 0
+        self.handle = None
+        # a future while the transport is above its high-water mark
+        self.writable = None
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def write(self, data: bytes) -> None:
+        self.writelines([data])
+
+    def writelines(self, buffers: list) -> None:
+        for data in buffers:
+            self.buffers.append(data)
+            self.size += len(data)
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        """
+        Hands everything written so far to the transport.
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.buffers:
+            buffers, self.buffers, self.size = self.buffers, [], 0
+            self.transport.writelines(buffers)
+
+    def full(self) -> bool:
+        """
+        Returns whether more than the high-water mark of the transport is
+        buffered.
+        """
+        return self.size + self.transport.get_write_buffer_size() > self.transport.get_write_buffer_limits()[1]
+
+    async def drain(self) -> None:
+        if self.writer is not self.transport and self.transport.is_closing():
+            # the stream writer raises the error of the lost connection
+            self.flush()
+            await self.writer.drain()
+            return
+        if not self.full():
+            return
+        self.flush()
+        if self.writer is not self.transport:
+            await self.writer.drain()
+        elif self.writable is not None:
+            await self.writable
+
+    def pause_writing(self) -> None:
+        if self.writable is None:
+            self.writable = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self) -> None:
+        if self.writable is not None:
+            writable, self.writable = self.writable, None
+            writable.set_result(None)
+
+    def close(self) -> None:
+        self.flush()
+        self.transport.close()
+        self.resume_writing()
+
+    async def wait_closed(self) -> None:
+        if self.writer is not self.transport:
+            await self.writer.wait_closed()
+
+
 class Client():
     """
     This class is used to comunicate with the server.
     """
     def __init__(self):
         self.connected = False
-        self.receiving = False
+        self.receiving = 0
+        # packages requested from the server which didn't arrive yet
+        self.awaiting = 0
+        self.dead = False
+        self.queue = DEFAULT_QUEUE
+        self.receive_queue = DEFAULT_QUEUE
+        self.codec = None
+        self.reading = None
+        self.confirms = False
 
-    async def connect(self, host: str='127.0.0.1', port: int=SSPQ_PORT, loop=None) -> None:
+    async def connect(self, host: str='127.0.0.1', port: int=SSPQ_PORT, loop=None, compression: bool=False, endpoints: list=None, confirms: bool=False, window: int=1000, connection: tuple=None) -> None:
         """
-        This function connects the client to the server specified in the params
+        This function connects the client to the server specified in the params.
+        With compression the client negotiates a codec with the server and
+        compresses the payloads it sends. Compressed payloads are always
+        decompressed on receive. Endpoints is a list of further (host, port)
+        pairs which are tried in order if the server is not reachable, e.g.
+        the standby of the server.
+
+        With confirms the server acknowledges every send package once the
+        messages are queued, and persisted if it runs with a write-ahead log.
+        send and send_many then return a future resolved by the acknowledgement
+        and wait while window send packages are not acknowledged yet.
+
+        Connection is an already open pair of stream reader and writer, e.g.
+        of an in-process connection, which is used instead of connecting to
+        host and port.
+
+        Loop is deprecated and ignored, the client always runs on the running
+        event loop.
         """
+        if loop is not None:
+            warnings.warn('The loop parameter is deprecated and ignored', DeprecationWarning, stacklevel=2)
         if self.connected:
             raise ClientStateException('Already connected!')
 
-        self.reader, self.writer = await asyncio.open_connection(host=host, port=port, loop=loop)
+        if connection is not None:
+            self.reader, writer = connection
+        else:
+            candidates = [(host, port)] + list(endpoints or [])
+            for index, (host, port) in enumerate(candidates):
+                try:
+                    self.reader, writer = await asyncio.open_connection(host=host, port=port)
+                    break
+                except OSError:
+                    if index == len(candidates) - 1:
+                        raise
+        self.writer = FrameWriter(writer)
         self.connected = True
+        self.queue = DEFAULT_QUEUE
+        self.codec = None
+        self.reading = None
+        self.confirms = False
+        if compression:
+            await self._hello()
+        if confirms:
+            await self._enable_confirms(window)
+
+    async def _enable_confirms(self, window: int) -> None:
+        """
+        Asks the server to acknowledge the send packages and starts reading
+        the acknowledgements in the background. All other packages are handed
+        to the reading functions by the background task from then on.
+        """
+        if window < 1:
+            raise ValueError('window needs to be at least 1')
+        await Message(MessageType.ACK).send(self.writer)
+        msg = await read_message(self.reader)
+        if msg.type != MessageType.ACK:
+            raise ServerStateException('Server answerd with an unknown package')
+        self.window = window
+        self.confirms = True
+        self._start_reading()
+
+    def _start_reading(self) -> None:
+        """
+        Starts reading the packages in the background, so the reading
+        functions can tell which packages already arrived.
+        """
+        if self.reading is not None:
+            return
+        self.sequence = 0
+        self.acked = 0
+        self.acks = deque()
+        self.window_free = asyncio.Event()
+        self.incoming = asyncio.Queue()
+        self.failure = None
+        self.reading = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                msg = await read_message(self.reader)
+                if msg.type != MessageType.ACK:
+                    self.incoming.put_nowait(msg)
+                    continue
+                if not self.confirms or msg.payload_size < SEQUENCE.size:
+                    raise MessageException('Invalid acknowledgement')
+                self.acked = SEQUENCE.unpack_from(msg.payload)[0]
+                while self.acks and self.acks[0][0] <= self.acked:
+                    future = self.acks.popleft()[1]
+                    if not future.done():
+                        future.set_result(None)
+                if self.sequence - self.acked < self.window:
+                    self.window_free.set()
+        except (OSError, EOFError, MessageException) as e:
+            self.failure = e
+        except asyncio.CancelledError:
+            self.failure = ConnectionError('Client disconnected')
+        # the sends which were not acknowledged may be lost
+        while self.acks:
+            future = self.acks.popleft()[1]
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection lost before the server acknowledged the package ({self.failure!r})'))
+        self.window_free.set()
+        self.incoming.put_nowait(self.failure)
+
+    async def _read(self) -> Message:
+        """
+        Reads the next package which is not an acknowledgement.
+        """
+        if self.reading is None:
+            return await read_message(self.reader)
+        msg = await self.incoming.get()
+        if isinstance(msg, Exception):
+            # every later read fails the same way
+            self.incoming.put_nowait(msg)
+            raise msg
+        return msg
+
+    async def _acknowledged(self):
+        """
+        Waits until the window allows another send package and returns the
+        future of its acknowledgement, or None without confirms. This has to
+        be called right before the package is written.
+        """
+        if not self.confirms:
+            return None
+        while self.failure is None and self.sequence - self.acked >= self.window:
+            self.window_free.clear()
+            await self.window_free.wait()
+        if self.failure is not None:
+            raise ConnectionError(f'Connection lost ({self.failure!r})')
+        self.sequence += 1
+        future = asyncio.get_event_loop().create_future()
+        self.acks.append((self.sequence, future))
+        return future
+
+    async def _hello(self) -> None:
+        """
+        Tells the server which codecs the client can decompress and picks the
+        preferred codec the server can decompress as well.
+        """
+        codecs = bytes(sorted(CODECS))
+        await Message(MessageType.HELLO, payload_size=len(codecs), payload=codecs).send(self.writer)
+        msg = await read_message(self.reader)
+        if msg.type != MessageType.HELLO:
+            raise ServerStateException('Server answerd with an unknown package')
+        for codec in CODEC_PREFERENCE:
+            if codec in CODECS and codec in msg.payload:
+                self.codec = codec
+                break
 
-    async def send(self, message: bytes, retrys: int=3) -> None:
+    async def send(self, message: bytes, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_id: bytes=None) -> asyncio.Future:
         """
         This function is used to send data packages to the queue. It can be used
-        in any connected state of the client.
+        in any connected state of the client. Messages with a higher priority
+        (0-255) are received first, a delay in seconds holds the message back.
+        A server with deduplication drops the message if another message with
+        the same message_id (1-255 bytes) was sent to the queue shortly before.
+        With confirms a future is returned which is resolved once the server
+        acknowledged the message, see connect.
+        """
+        if not self.connected:
+            raise ClientStateException('Need to connect first!')
+
+        await self._select(queue)
+        msg = Message(MessageType.SEND, retrys, len(message), message, priority, _deliver_at(delay), message_id=_message_id(message_id))
+        if self.codec is not None:
+            compress_message(msg, self.codec)
+        acknowledged = await self._acknowledged()
+        await msg.send(self.writer)
+        return acknowledged
+
+    async def send_many(self, messages: list, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_ids: list=None) -> asyncio.Future:
+        """
+        This function sends multiple data packages to the queue with a single
+        SEND_BATCH package. It can be used in any connected state of the client.
+        message_ids holds the message id of every data package, see send.
+        With confirms a future is returned which is resolved once the server
+        acknowledged all messages, see connect.
         """
         if not self.connected:
             raise ClientStateException('Need to connect first!')
 
-        msg = Message(MessageType.SEND, retrys, len(message), message)
+        await self._select(queue)
+        messages = _send_messages(messages, retrys, priority, delay, message_ids)
+        if self.codec is not None:
+            for msg in messages:
+                compress_message(msg, self.codec)
+        batch = encode_batch(messages)
+        msg = Message(MessageType.SEND_BATCH, payload_size=len(batch), payload=batch)
+        acknowledged = await self._acknowledged()
         await msg.send(self.writer)
+        return acknowledged
 
-    async def receive(self, dead: bool=False) -> bytes:
+    async def receive(self, dead: bool=False, queue: str=DEFAULT_QUEUE, timeout: float=None) -> bytes:
         """
         This function is used to get a package from the queue. It is blocking
-        until the data is received.
+        until the data is received. The timeout overrides the seconds the
+        server waits for the confirmation before requeueing the message, 0
+        disables it.
         """
         if not self.connected:
             raise ClientStateException('Need to connect first!')
@@ -151,36 +553,164 @@ class Client():
             raise ClientStateException('Can\'t receive a new package while still working on an old one.')
 
         # tell the server the client is ready to receive
-        msg = Message(MessageType.RECEIVE if not dead else MessageType.DEAD_RECEIVE)
+        await self._select(queue)
+        payload = _encode_timeout(timeout)
+        msg = Message(MessageType.RECEIVE if not dead else MessageType.DEAD_RECEIVE, payload_size=len(payload), payload=payload)
         await msg.send(self.writer)
-        self.receiving = True
+        self.receiving = 1
+        self.awaiting = 1
+        self.dead = dead
+        self.receive_queue = queue
 
         # receive and process the message
-        msg = await read_message(self.reader)
+        return await self._read_payload()
+
+    async def receive_many(self, count: int, dead: bool=False, queue: str=DEFAULT_QUEUE, timeout: float=None) -> list:
+        """
+        This function keeps count packages requested from the server and
+        returns the ones which arrived so far, but at least one. It blocks
+        until the first package is received. The packages are streamed by the
+        server as soon as they are available, requested packages which didn't
+        arrive yet are returned by the next calls. Unlike receive this can
+        already be called while older packages are unconfirmed, as long as
+        they are from the same queue, which allows to work through a prefetch
+        window while it is refilled. The timeout works like the one of
+        receive and applies to the newly requested packages.
+        """
+        if not self.connected:
+            raise ClientStateException('Need to connect first!')
+        if count < 1:
+            raise ValueError('count needs to be at least 1')
+        if self.receiving and (self.dead != dead or self.receive_queue != queue):
+            raise ClientStateException('Can\'t mix packages from different queues.')
+
+        # tell the server how many more messages the client is ready to
+        # receive, the ones which didn't arrive yet are still on their way
+        missing = count - self.awaiting
+        if missing > 0:
+            await self._select(queue)
+            payload = COUNT.pack(missing) + _encode_timeout(timeout)
+            msg = Message(MessageType.RECEIVE_MANY if not dead else MessageType.DEAD_RECEIVE_MANY, payload_size=len(payload), payload=payload)
+            await msg.send(self.writer)
+            self.receiving += missing
+            self.awaiting += missing
+        self.dead = dead
+        self.receive_queue = queue
+
+        # the background reader tells which packages already arrived
+        self._start_reading()
+        messages = [await self._read_payload()]
+        while len(messages) < count and not self.incoming.empty():
+            messages.append(await self._read_payload())
+        return messages
+
+    async def _select(self, queue: str) -> None:
+        """
+        Tells the server which queue the following packages are meant for.
+        """
+        if queue != self.queue:
+            name = queue.encode()
+            await Message(MessageType.QUEUE, payload_size=len(name), payload=name).send(self.writer)
+            self.queue = queue
+
+    async def _read_payload(self) -> bytes:
+        msg = await self._read()
         if msg.type == MessageType.SEND:
-            return msg.payload
+            self.awaiting -= 1
+            return decompress_payload(msg)
         elif msg.type == MessageType.NO_RECEIVE:
-            if dead:
+            self.receiving = 0
+            self.awaiting = 0
+            if self.dead:
                 raise ServerStateException('Server has no dead letter queue')
             else:
                 raise ServerStateException('Server blocks client from receiving')
         else:
             raise ServerStateException('Server answerd with an unknown package')
 
-    async def confirm(self) -> None:
+    async def confirm(self, count: int=1) -> None:
         """
-        This function confirms the finished processing of the message and finally
-        removes it from the queue server.
+        This function confirms the finished processing of the oldest count
+        messages and finally removes them from the queue server. Confirming
+        more than one message is done with a single CONFIRM_MANY package.
         """
         if not self.connected:
             raise ClientStateException('Need to connect first!')
-        if not self.receiving:
+        received = self.receiving - self.awaiting
+        if not received:
             raise ClientStateException('No package to confirm')
+        if count < 1 or count > received:
+            raise ClientStateException(f'Can\'t confirm {count} of {received} packages')
 
-        # confirm the last package to the server
-        msg = Message(MessageType.CONFIRM)
+        # confirm the packages to the server
+        if count == 1:
+            msg = Message(MessageType.CONFIRM)
+        else:
+            payload = COUNT.pack(count)
+            msg = Message(MessageType.CONFIRM_MANY, payload_size=len(payload), payload=payload)
         await msg.send(self.writer)
-        self.receiving = False
+        self.receiving -= count
+
+    async def extend(self, timeout: float=None) -> None:
+        """
+        This function tells the server that the client is still working on
+        its unconfirmed messages and restarts their visibility timeout, either
+        with the given seconds or the timeout they were received with.
+        """
+        if not self.connected:
+            raise ClientStateException('Need to connect first!')
+        if not self.receiving:
+            raise ClientStateException('No package to extend')
+
+        payload = _encode_timeout(timeout)
+        await Message(MessageType.EXTEND, payload_size=len(payload), payload=payload).send(self.writer)
+
+    async def stats(self, queue: str=DEFAULT_QUEUE) -> dict:
+        """
+        This function returns the number of waiting, delayed and dead messages
+        of the queue and the number of waiting consumers.
+        """
+        return await self._admin(queue, command='stats')
+
+    async def peek(self, count: int=10, dead: bool=False, queue: str=DEFAULT_QUEUE) -> list:
+        """
+        This function returns the payloads of the next count packages of the
+        queue or its dead letter queue without removing them.
+        """
+        result = await self._admin(queue, command='peek', count=count, dead=dead)
+        return [base64.b64decode(message['payload']) for message in result['messages']]
+
+    async def purge(self, dead: bool=False, queue: str=DEFAULT_QUEUE) -> int:
+        """
+        This function removes all packages of the queue or its dead letter
+        queue and returns how many were removed.
+        """
+        return (await self._admin(queue, command='purge', dead=dead))['purged']
+
+    async def replay(self, count: int=0, retrys: int=3, queue: str=DEFAULT_QUEUE) -> int:
+        """
+        This function lets the server move count packages, or all if count is
+        0, from the dead letter queue back to the queue with a fresh retry
+        counter. It returns how many packages were moved.
+        """
+        return (await self._admin(queue, command='replay', count=count, retries=retrys))['replayed']
+
+    async def _admin(self, queue: str, **request) -> dict:
+        if not self.connected:
+            raise ClientStateException('Need to connect first!')
+        if self.receiving:
+            raise ClientStateException('Can\'t run admin commands while receiving packages.')
+
+        await self._select(queue)
+        payload = json.dumps(request).encode()
+        await Message(MessageType.ADMIN, payload_size=len(payload), payload=payload).send(self.writer)
+        msg = await self._read()
+        if msg.type != MessageType.ADMIN:
+            raise ServerStateException('Server answerd with an unknown package')
+        result = json.loads(msg.payload.decode())
+        if 'error' in result:
+            raise ServerStateException(result['error'])
+        return result
 
     async def disconnect(self) -> None:
         """
@@ -189,35 +719,508 @@ class Client():
         if not self.connected:
             raise ClientStateException('Need to connect first!')
 
+        if self.reading is not None:
+            # give the server the chance to acknowledge everything sent
+            if self.acks:
+                await asyncio.wait([self.acks[-1][1]])
+            self.reading.cancel()
         await self.writer.drain()
         self.writer.close()
         await self.writer.wait_closed()
         self.connected = False
 
 
+class PoolMessage():
+    """
+    This is a message received by a consumer of a ClientPool. The consumer
+    waits until the message is confirmed or rejected before it receives the
+    next one.
+    """
+    def __init__(self, payload: bytes, client: Client):
+        self.payload = payload
+        self.client = client
+        self.confirmed = False
+        self.rejected = False
+        self.done = asyncio.Event()
+
+    async def confirm(self) -> None:
+        """
+        This function confirms the message. If the connection it was received
+        with is lost, the server already requeued the message and a
+        ConnectionError is raised.
+        """
+        if self.done.is_set():
+            raise ClientStateException('Message is already finished')
+        try:
+            await self.client.confirm()
+            self.confirmed = True
+        finally:
+            self.done.set()
+
+    async def reject(self) -> None:
+        """
+        This function gives the message back without confirming it. The
+        connection it was received with is closed, so the server requeues
+        the message like any other unconfirmed message, and the consumer
+        continues with a new connection.
+        """
+        if self.done.is_set():
+            raise ClientStateException('Message is already finished')
+        self.rejected = True
+        self.client.writer.close()
+        self.done.set()
+
+
+class ClientPool():
+    """
+    This class keeps multiple connections to the server. Sends are spread over
+    the connections round-robin, lost connections are replaced with an
+    exponential backoff and consume runs concurrent consumers, each on its
+    own connection. The loop param is deprecated and ignored.
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=SSPQ_PORT, size: int=4, reconnect_delay: float=0.1, max_reconnect_delay: float=10.0, loop=None, compression: bool=False, endpoints: list=None, confirms: bool=False):
+        if loop is not None:
+            warnings.warn('The loop parameter is deprecated and ignored', DeprecationWarning, stacklevel=2)
+        if size < 1:
+            raise ValueError('size needs to be at least 1')
+        self.host = host
+        self.port = port
+        self.endpoints = endpoints
+        self.confirms = confirms
+        self.size = size
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.compression = compression
+        self.clients = []
+        self.locks = []
+        self.next = 0
+        self.consumers = set()
+        self.closed = True
+
+    async def connect(self) -> None:
+        """
+        This function opens all connections of the pool. Unlike later
+        reconnects, the first connect fails if the server is not reachable.
+        """
+        if not self.closed:
+            raise ClientStateException('Already connected!')
+
+        self.clients = []
+        for _ in range(self.size):
+            client = Client()
+            await client.connect(host=self.host, port=self.port, compression=self.compression, endpoints=self.endpoints, confirms=self.confirms)
+            self.clients.append(client)
+        self.locks = [asyncio.Lock() for _ in self.clients]
+        self.closed = False
+
+    async def send(self, message: bytes, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_id: bytes=None) -> asyncio.Future:
+        """
+        This function sends a data package with the next connection of the
+        pool. See Client.send for the arguments and the result.
+        """
+        return await self._run(lambda client: client.send(message, retrys, queue, priority, delay, message_id))
+
+    async def send_many(self, messages: list, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_ids: list=None) -> asyncio.Future:
+        """
+        This function sends multiple data packages with the next connection of
+        the pool. See Client.send_many for the arguments and the result.
+        """
+        return await self._run(lambda client: client.send_many(messages, retrys, queue, priority, delay, message_ids))
+
+    async def consume(self, queue: str=DEFAULT_QUEUE, concurrency: int=1, dead: bool=False, timeout: float=None):
+        """
+        This asynchronous generator receives messages with concurrency extra
+        connections and yields them as PoolMessage objects, so up to
+        concurrency messages can be worked on at the same time. Every message
+        has to be confirmed or rejected before its consumer receives the next
+        one. A consumer whose connection is lost reconnects and continues.
+        """
+        if self.closed:
+            raise ClientStateException('Need to connect first!')
+        if concurrency < 1:
+            raise ValueError('concurrency needs to be at least 1')
+
+        messages = asyncio.Queue()
+        consumers = [asyncio.ensure_future(self._consume(queue, dead, timeout, messages)) for _ in range(concurrency)]
+        self.consumers.update(consumers)
+        try:
+            while True:
+                message = await messages.get()
+                if isinstance(message, Exception):
+                    raise message
+                yield message
+        finally:
+            for consumer in consumers:
+                consumer.cancel()
+                self.consumers.discard(consumer)
+
+    async def close(self) -> None:
+        """
+        This function stops all consumers and closes all connections.
+        """
+        if self.closed:
+            raise ClientStateException('Need to connect first!')
+
+        self.closed = True
+        for consumer in self.consumers:
+            consumer.cancel()
+        self.consumers = set()
+        for client in self.clients:
+            if client.connected and not _lost(client):
+                await client.disconnect()
+        self.clients = []
+
+    async def _run(self, operation):
+        """
+        Runs the operation with the next connection and replaces the
+        connection if it is lost. A message is only sent again if the
+        connection was found broken before it was written.
+        """
+        if self.closed:
+            raise ClientStateException('Need to connect first!')
+
+        index = self.next
+        self.next = (index + 1) % len(self.clients)
+        async with self.locks[index]:
+            while True:
+                if _lost(self.clients[index]):
+                    self.clients[index] = await self._reconnect()
+                try:
+                    return await operation(self.clients[index])
+                except ConnectionError:
+                    self.clients[index] = await self._reconnect()
+
+    async def _reconnect(self) -> Client:
+        """
+        Connects a new client and retries with an exponential backoff until
+        the server is reachable again or the pool is closed.
+        """
+        delay = self.reconnect_delay
+        while True:
+            if self.closed:
+                raise ClientStateException('Pool is closed')
+            client = Client()
+            try:
+                await client.connect(host=self.host, port=self.port, compression=self.compression, endpoints=self.endpoints, confirms=self.confirms)
+                return client
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _consume(self, queue: str, dead: bool, timeout: float, messages: asyncio.Queue) -> None:
+        client = None
+        try:
+            while True:
+                if client is None:
+                    client = await self._reconnect()
+                try:
+                    payload = await client.receive(dead=dead, queue=queue, timeout=timeout)
+                except (OSError, EOFError, MessageException):
+                    client.writer.close()
+                    client = None
+                    continue
+                message = PoolMessage(payload, client)
+                await messages.put(message)
+                await message.done.wait()
+                if message.rejected:
+                    client = None
+        except ServerStateException as e:
+            await messages.put(e)
+        finally:
+            if client is not None:
+                client.writer.close()
+
+
+
+class SyncClient():
+    """
+    This is a blocking and thread-safe client for code which doesn't run in
+    an event loop. The connections are run by one event loop in a background
+    thread shared by all SyncClients. Sends of all threads go through one
+    connection and are written as one SEND_BATCH package when they come in
+    faster than they are written. Every thread receives and confirms with
+    its own connection.
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=SSPQ_PORT, compression: bool=False, endpoints: list=None):
+        self.host = host
+        self.port = port
+        self.endpoints = endpoints
+        self.compression = compression
+        self.loop = None
+        self.producer = None
+        self.consumers = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushing = False
+
+    def connect(self) -> None:
+        """
+        This function connects the client to the server.
+        """
+        if self.producer is not None:
+            raise ClientStateException('Already connected!')
+
+        self.loop = _background_loop()
+        self.producer = self._call(self._connect())
+
+    def send(self, message: bytes, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_id: bytes=None) -> None:
+        """
+        This function sends a data package and blocks until it is handed to
+        the connection. See Client.send for the arguments.
+        """
+        self._send([Message(MessageType.SEND, retrys, len(message), message, priority, _deliver_at(delay), message_id=_message_id(message_id))], queue)
+
+    def send_many(self, messages: list, retrys: int=3, queue: str=DEFAULT_QUEUE, priority: int=0, delay: float=None, message_ids: list=None) -> None:
+        """
+        This function sends multiple data packages and blocks until they are
+        handed to the connection. See Client.send_many for the arguments.
+        """
+        self._send(_send_messages(messages, retrys, priority, delay, message_ids), queue)
+
+    def receive(self, dead: bool=False, queue: str=DEFAULT_QUEUE, timeout: float=None) -> bytes:
+        """
+        This function blocks until a data package is received with the
+        connection of the calling thread. See Client.receive for the arguments.
+        """
+        return self._call(self._consumer().receive(dead, queue, timeout))
+
+    def receive_many(self, count: int, dead: bool=False, queue: str=DEFAULT_QUEUE, timeout: float=None) -> list:
+        """
+        This function blocks until count data packages are received with the
+        connection of the calling thread. See Client.receive_many for the
+        arguments.
+        """
+        return self._call(self._consumer().receive_many(count, dead, queue, timeout))
+
+    def confirm(self, count: int=1) -> None:
+        """
+        This function confirms the oldest count data packages received by the
+        calling thread.
+        """
+        self._call(self._consumer().confirm(count))
+
+    def extend(self, timeout: float=None) -> None:
+        """
+        This function restarts the visibility timeout of the data packages
+        received by the calling thread.
+        """
+        self._call(self._consumer().extend(timeout))
+
+    def disconnect(self) -> None:
+        """
+        This function closes all connections of the client.
+        """
+        if self.producer is None:
+            raise ClientStateException('Need to connect first!')
+
+        for client in [self.producer] + self.consumers:
+            self._call(client.disconnect())
+        self.producer = None
+        self.consumers = []
+        self.local = threading.local()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _consumer(self) -> Client:
+        if self.producer is None:
+            raise ClientStateException('Need to connect first!')
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self._call(self._connect())
+            with self.lock:
+                self.consumers.append(client)
+            self.local.client = client
+        return client
+
+    async def _connect(self) -> Client:
+        client = Client()
+        await client.connect(host=self.host, port=self.port, compression=self.compression, endpoints=self.endpoints)
+        return client
+
+    def _send(self, messages: list, queue: str) -> None:
+        if self.producer is None:
+            raise ClientStateException('Need to connect first!')
+
+        # compress in the calling thread instead of the shared loop
+        if self.producer.codec is not None:
+            for message in messages:
+                compress_message(message, self.producer.codec)
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.pending.append((queue, messages, future))
+            if not self.flushing:
+                self.flushing = True
+                self.loop.call_soon_threadsafe(asyncio.ensure_future, self._flush())
+        future.result()
+
+    async def _flush(self) -> None:
+        """
+        Writes everything sent meanwhile by any thread, the messages of
+        consecutive sends to the same queue as a single package.
+        """
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                if not pending:
+                    self.flushing = False
+                    return
+            try:
+                for queue, group in itertools.groupby(pending, key=lambda entry: entry[0]):
+                    messages = [message for _queue, entry, _future in group for message in entry]
+                    await self.producer._select(queue)
+                    if len(messages) == 1:
+                        self.producer.writer.writelines(messages[0].frame())
+                    else:
+                        batch = encode_batch(messages)
+                        self.producer.writer.writelines(Message(MessageType.SEND_BATCH, payload_size=len(batch), payload=batch).frame())
+                await self.producer.writer.drain()
+            except Exception as e:
+                for _queue, _messages, future in pending:
+                    future.set_exception(e)
+            else:
+                for _queue, _messages, future in pending:
+                    future.set_result(None)
+
+
 
 #
 # --- Functions ---
 #
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop of the background thread and starts it first if
+    necessary.
+    """
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='sspq-loop', daemon=True).start()
+            _LOOP = loop
+        return _LOOP
+
+
+def _lost(client: Client) -> bool:
+    return client.reader.at_eof() or client.writer.transport.is_closing()
+
+
+def _encode_timeout(timeout: float) -> bytes:
+    if timeout is None:
+        return b''
+    return COUNT.pack(max(int(timeout * 1000), 0))
+
+
+def _deliver_at(delay: float) -> int:
+    if not delay:
+        return 0
+    return int((time.time() + delay) * 1000)
+
+
+def _message_id(message_id: bytes) -> bytes:
+    if message_id is not None and not 0 < len(message_id) < 256:
+        raise ValueError('message_id needs to be 1 to 255 bytes long')
+    return message_id
+
+
+def _send_messages(messages: list, retrys: int, priority: int, delay: float, message_ids: list) -> list:
+    """
+    Creates the SEND messages of a send_many call.
+    """
+    if message_ids is None:
+        message_ids = [None] * len(messages)
+    elif len(message_ids) != len(messages):
+        raise ValueError('message_ids needs one id per message')
+    deliver_at = _deliver_at(delay)
+    return [Message(MessageType.SEND, retrys, len(message), message, priority, deliver_at, message_id=_message_id(message_id)) for message, message_id in zip(messages, message_ids)]
+
+
+def compress_message(message: Message, codec: int) -> None:
+    """
+    This compresses the payload of the message with the given codec, unless
+    the payload is too small or doesn't get any smaller.
+    """
+    if message.compressed or message.payload_size < COMPRESSION_THRESHOLD:
+        return
+    payload = bytes((codec,)) + CODECS[codec][0](message.payload)
+    if len(payload) < message.payload_size:
+        message.payload = payload
+        message.payload_size = len(payload)
+        message.compressed = True
+
+
+def decompress_payload(message: Message) -> bytes:
+    """
+    This returns the decompressed payload of the message. A MessageException
+    is raised if the codec is unknown or the payload is corrupt.
+    """
+    if not message.compressed:
+        return message.payload
+    if message.payload_size < 1 or message.payload[0] not in CODECS:
+        raise MessageException('Unsupported compression codec')
+    try:
+        return CODECS[message.payload[0]][1](message.payload[1:])
+    except Exception:
+        raise MessageException('Corrupt compressed payload')
+
+
+def encode_batch(messages: list) -> bytes:
+    """
+    This encodes a list of messages as the payload of a SEND_BATCH package,
+    which is simply the concatenation of the encoded messages.
+    """
+    return b''.join(message.encode() for message in messages)
+
+
+def decode_batch(payload: bytes) -> list:
+    """
+    This splits the payload of a SEND_BATCH package back into the contained
+    messages. A MessageException is raised if the payload is malformed.
+    """
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < HEADER.size:
+            raise MessageException('Incomplete message header in batch')
+        mv, _type, retries, size = HEADER.unpack_from(payload, offset)
+        if mv != MAGIC_VALUE:
+            raise MessageException('Magic value check failed in batch')
+        offset += HEADER.size
+        length = size & SIZE_MASK
+        if len(payload) - offset < length:
+            raise MessageException('Incomplete message payload in batch')
+        messages.append(Message.decode(_type, retries, size, payload[offset:offset + length]))
+        offset += length
+    return messages
+
+
 async def read_message(reader: asyncio.StreamReader) -> Message:
     """
     This function reads exacly one message from the asyncio.StreamReader and
     returns it as a Message. A MessageException is raised when the magic value
-    check fails.
+    check fails or the connection is closed in the middle of a message.
+
+    The header is read and parsed in one step and the payload is read with a
+    single readexactly call, so the returned Message holds the bytes object
+    created by the reader without any further copies.
     """
-    mv = await reader.read(n=2)
-    if mv != MAGIC_VALUE:
-        if mv == b'':
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial == b'':
             raise EOFError()
-        else:
-            raise MessageException('Magic value check failed')
+        raise MessageException('Incomplete message header')
 
-    _type = await reader.read(n=1)
-    type = MessageType.get(_type)
-    _retries = await reader.read(n=1)
-    retries = int.from_bytes(_retries, byteorder='big', signed=False)
-    _payload_size = await reader.read(n=4)
-    payload_size = int.from_bytes(_payload_size, byteorder='big', signed=False)
-    payload = await reader.read(n=payload_size)
+    mv, _type, retries, size = HEADER.unpack(header)
+    if mv != MAGIC_VALUE:
+        raise MessageException('Magic value check failed')
+
+    payload = b''
+    if size & SIZE_MASK > 0:
+        try:
+            payload = await reader.readexactly(size & SIZE_MASK)
+        except asyncio.IncompleteReadError:
+            raise MessageException('Incomplete message payload')
 
-    return Message(type=type, retries=retries, payload_size=payload_size, payload=payload)
+    return Message.decode(_type, retries, size, payload)
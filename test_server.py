@@ -0,0 +1,83 @@
+import asyncio
+import tempfile
+import unittest
+from sspq import *
+from server import SSPQServer
+
+
+
+ENGINES = ('streams', 'protocol')
+
+
+async def _receive_all(server: SSPQServer, count: int) -> list:
+    consumer = await server.connect()
+    payloads = []
+    while len(payloads) < count:
+        payloads += await asyncio.wait_for(consumer.receive_many(count - len(payloads)), 5)
+    await consumer.confirm(len(payloads))
+    await consumer.disconnect()
+    return payloads
+
+
+
+class PausedProducerTest(unittest.TestCase):
+    def run_engines(self, test):
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                asyncio.run(test(engine))
+
+    def test_paused_producer_can_consume(self):
+        async def test(engine):
+            async with SSPQServer(port=None, engine=engine, high_watermark=5) as server:
+                client = await server.connect()
+                for i in range(10):
+                    await client.send(b'%d' % i)
+                for i in range(10):
+                    self.assertEqual(await asyncio.wait_for(client.receive(), 5), b'%d' % i)
+                    await client.confirm()
+                await client.disconnect()
+
+        self.run_engines(test)
+
+    def test_held_sends_survive_disconnect(self):
+        async def test(engine):
+            async with SSPQServer(port=None, engine=engine, high_watermark=10) as server:
+                producer = await server.connect()
+                for i in range(50):
+                    await producer.send(b'%d' % i)
+                await producer.disconnect()
+                payloads = await _receive_all(server, 50)
+                self.assertEqual(payloads, [b'%d' % i for i in range(50)])
+
+        self.run_engines(test)
+
+    def test_rate_limited_sends_survive_disconnect(self):
+        async def test(engine):
+            async with SSPQServer(port=None, engine=engine, rate_limit=50) as server:
+                producer = await server.connect()
+                for i in range(60):
+                    await producer.send(b'%d' % i)
+                await producer.disconnect()
+                payloads = await _receive_all(server, 60)
+                self.assertEqual(payloads, [b'%d' % i for i in range(60)])
+
+        self.run_engines(test)
+
+    def test_held_sends_survive_stop(self):
+        async def test(engine):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            async with SSPQServer(port=None, engine=engine, high_watermark=10, wal=directory.name) as server:
+                producer = await server.connect()
+                for i in range(50):
+                    await producer.send(b'%d' % i)
+            async with SSPQServer(port=None, engine=engine, wal=directory.name) as server:
+                payloads = await _receive_all(server, 50)
+                self.assertEqual(payloads, [b'%d' % i for i in range(50)])
+
+        self.run_engines(test)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
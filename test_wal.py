@@ -0,0 +1,163 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from sspq import *
+from wal import WriteAheadLog
+
+
+
+# Enqueues and syncs one message, then forces the log to compact the segment
+# of that message with enqueue and remove traffic and crashes while the
+# rewritten message is still in the buffer of the newest segment.
+CRASH = textwrap.dedent('''
+    import asyncio, os, sys
+    from sspq import *
+    from wal import WriteAheadLog
+
+    async def main(directory):
+        wal = WriteAheadLog(directory, segment_size=4096)
+        wal.recover()
+        wal.enqueue(Message(MessageType.SEND, 3, 4, b'kept'))
+        await wal.sync()
+        payload = b'x' * 512
+        # the third segment is opened right before the first one is compacted
+        while wal.segments[-1].number < 3:
+            message = Message(MessageType.SEND, 3, len(payload), payload)
+            wal.enqueue(message)
+            wal.remove(message)
+        os._exit(0)
+
+    asyncio.run(main(sys.argv[1]))
+''')
+
+
+def _message(payload: bytes) -> Message:
+    return Message(MessageType.SEND, 3, len(payload), payload)
+
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def recover(self) -> (list, list):
+        wal = WriteAheadLog(self.directory.name)
+        try:
+            return wal.recover()
+        finally:
+            wal.close()
+
+    def test_recover(self):
+        async def write():
+            wal = WriteAheadLog(self.directory.name)
+            wal.recover()
+            first, second, third = _message(b'first'), _message(b'second'), _message(b'third')
+            for message in (first, second, third):
+                wal.enqueue(message)
+            wal.remove(second)
+            wal.dead(third)
+            await wal.sync()
+            wal.close()
+
+        asyncio.run(write())
+        queue, dead_letter_queue = self.recover()
+        self.assertEqual([message.payload for message in queue], [b'first'])
+        self.assertEqual([message.payload for message in dead_letter_queue], [b'third'])
+
+    def test_torn_record(self):
+        async def write():
+            wal = WriteAheadLog(self.directory.name)
+            wal.recover()
+            wal.enqueue(_message(b'complete'))
+            await wal.sync()
+            wal.close()
+
+        asyncio.run(write())
+        path = os.path.join(self.directory.name, sorted(os.listdir(self.directory.name))[0])
+        with open(path, 'ab') as file:
+            file.write(_message(b'torn').encode()[:-2])
+        queue, _ = self.recover()
+        self.assertEqual([message.payload for message in queue], [b'complete'])
+
+    def test_crash_during_compaction(self):
+        directory = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run([sys.executable, '-c', CRASH, self.directory.name], cwd=directory, check=True)
+        queue, _ = self.recover()
+        self.assertEqual([message.payload for message in queue], [b'kept'])
+
+    def test_compacted_segments_are_deleted_after_sync(self):
+        async def write():
+            wal = WriteAheadLog(self.directory.name, segment_size=4096)
+            wal.recover()
+            wal.enqueue(_message(b'kept'))
+            payload = b'x' * 512
+            for _ in range(200):
+                message = _message(payload)
+                wal.enqueue(message)
+                wal.remove(message)
+            segments = len(os.listdir(self.directory.name))
+            await wal.sync()
+            await wal.sync()
+            self.assertLess(len(os.listdir(self.directory.name)), segments)
+            wal.close()
+
+        asyncio.run(write())
+        queue, _ = self.recover()
+        self.assertEqual([message.payload for message in queue], [b'kept'])
+
+    def test_close_during_sync(self):
+        async def write():
+            wal = WriteAheadLog(self.directory.name, segment_size=4096, sync_interval=0)
+            wal.recover()
+            payload = b'x' * 512
+            while wal.segments[-1].number < 6:
+                message = _message(payload)
+                wal.enqueue(message)
+                wal.remove(message)
+            for i in range(30):
+                wal.enqueue(_message(b'%d' % i))
+            synced = wal.sync()
+            while not wal.syncing:
+                await asyncio.sleep(0)
+            # the sync finishes in the executor while its callback can't run
+            time.sleep(0.2)
+            wal.close()
+            await asyncio.wait_for(synced, 1)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(write())
+        queue, _ = self.recover()
+        self.assertEqual([message.payload for message in queue], [b'%d' % i for i in range(30)])
+
+    def test_compaction_keeps_the_log_small(self):
+        async def write():
+            wal = WriteAheadLog(self.directory.name, segment_size=4096)
+            wal.recover()
+            messages = [_message(b'%d' % i + b'x' * 64) for i in range(3000)]
+            for i, message in enumerate(messages):
+                wal.enqueue(message)
+                if i % 10:
+                    wal.remove(message)
+                if i % 100 == 0:
+                    await wal.sync()
+            await wal.sync()
+            await wal.sync()
+            # the live messages and the records removing the others take
+            # less than a tenth of the segments written
+            self.assertLess(len(os.listdir(self.directory.name)), 30)
+            wal.close()
+
+        asyncio.run(write())
+        queue, _ = self.recover()
+        self.assertEqual(len(queue), 300)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+This is a hashed timer wheel used by the sspq server for the visibility
+timeouts of messages. Scheduling and cancelling a timer is O(1), which matters
+because nearly every timer is cancelled again when its message is confirmed.
+"""
+import asyncio
+import math
+
+
+__all__ = [
+    'Timer',
+    'TimerWheel'
+]
+
+
+
+#
+# --- Classes ---
+#
+class Timer():
+    """
+    This is a scheduled callback of a TimerWheel.
+    """
+    def __init__(self, callback, args: tuple, rounds: int, slot: int):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.slot = slot
+        self.cancelled = False
+
+
+class TimerWheel():
+    """
+    This runs callbacks after a delay with the given resolution in seconds.
+    Timers are kept in a ring of slots, one slot per tick. Timers further away
+    than one revolution wait the required number of rounds in their slot.
+    """
+    def __init__(self, resolution: float=0.1, size: int=512):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(size)]
+        self.position = 0
+        self.count = 0
+        self.handle = None
+        self.next_tick = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """
+        Calls callback(*args) after at least delay seconds.
+        """
+        loop = asyncio.get_event_loop()
+        if self.handle is None:
+            self.next_tick = loop.time() + self.resolution
+            self.handle = loop.call_at(self.next_tick, self._tick)
+        # the next tick may be due any moment, so the timer goes into the
+        # slot of the first tick after the delay ran out
+        ticks = max(1, math.ceil((loop.time() + delay - self.next_tick) / self.resolution) + 1)
+        slot = (self.position + ticks) % len(self.slots)
+        timer = Timer(callback, args, (ticks - 1) // len(self.slots), slot)
+        self.slots[slot].add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer) -> None:
+        """
+        Cancels the timer if it didn't run yet.
+        """
+        if timer.cancelled:
+            return
+        timer.cancelled = True
+        slots = self.slots[timer.slot]
+        if timer in slots:
+            slots.remove(timer)
+            self.count -= 1
+
+    def close(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _tick(self) -> None:
+        loop = asyncio.get_event_loop()
+        # catch up on ticks missed while the loop was busy
+        while self.next_tick <= loop.time() and self.count > 0:
+            self.position = (self.position + 1) % len(self.slots)
+            self.next_tick += self.resolution
+            slot = self.slots[self.position]
+            due = []
+            for timer in slot:
+                if timer.rounds == 0:
+                    due.append(timer)
+                else:
+                    timer.rounds -= 1
+            for timer in due:
+                slot.remove(timer)
+                self.count -= 1
+            # callbacks may schedule or cancel timers themselves
+            for timer in due:
+                if not timer.cancelled:
+                    timer.cancelled = True
+                    timer.callback(*timer.args)
+
+        if self.count > 0:
+            self.handle = loop.call_at(self.next_tick, self._tick)
+        else:
+            self.handle = None
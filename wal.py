@@ -0,0 +1,384 @@
+"""
+This is an append-only write-ahead log used by the sspq server to persist its
+queues. Every record is an encoded sspq message prefixed by the id of the
+message and a checksum, so the log uses the same encoding as the network.
+
+The log is split into numbered segment files. Records are written to the
+newest segment and synced to disk in groups, so many messages share one fsync.
+Segments without live messages are deleted, segments with only a few live
+messages left are compacted by rewriting those messages to the newest segment.
+A segment is only deleted once the records which replaced its messages are
+synced, so a crash never loses a message which was synced before.
+"""
+import asyncio
+import os
+import struct
+import threading
+import zlib
+from sspq import *
+
+
+__all__ = [
+    'DEAD',
+    'encode_record',
+    'ENQUEUE',
+    'read_records',
+    'record_of',
+    'REMOVE',
+    'WriteAheadLog'
+]
+
+
+
+#
+# --- Constants ---
+#
+# message id, crc32 of the encoded message
+RECORD = struct.Struct('!QI')
+SEGMENT_SUFFIX = '.log'
+
+# record types
+ENQUEUE = MessageType.SEND
+DEAD = MessageType.DEAD_RECEIVE
+REMOVE = MessageType.CONFIRM
+
+
+
+#
+# --- Classes ---
+#
+class Segment():
+    """
+    This is a single segment file of the log.
+    """
+    def __init__(self, number: int, path: str):
+        self.number = number
+        self.path = path
+        self.records = 0
+        self.live = 0
+        self.size = 0
+
+
+class WriteAheadLog():
+    """
+    This is the write-ahead log of one message queue and its dead letter queue.
+    """
+    def __init__(self, directory: str, segment_size: int=64 * 1024 * 1024, sync_interval: float=0.005, compact_ratio: float=0.25):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.segments = []
+        self.live = {}
+        self.next_id = 1
+        self.file = None
+        self.unsynced = []
+        self.waiters = []
+        self.sync_handle = None
+        self.syncing = False
+        self.syncing_files = []
+        self.dirty = False
+        self.compacting = False
+        self.closed = False
+        # held while files are synced or closed, so the executor and close
+        # don't use a file at the same time
+        self.lock = threading.Lock()
+
+    def recover(self) -> (list, list):
+        """
+        This reads all segments, truncates a torn record at the end of a
+        segment and returns the live messages of the queue and of the dead
+        letter queue in the order they were queued. It has to be called once
+        before the log is written to.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+        state = {}
+        for number in numbers:
+            segment = Segment(number, self._path(number))
+            self.segments.append(segment)
+            for id, record in self._read_segment(segment):
+                if id >= self.next_id:
+                    self.next_id = id + 1
+                previous = state.pop(id, None)
+                if previous is not None:
+                    previous[1].live -= 1
+                if record.type != REMOVE:
+                    segment.live += 1
+                    state[id] = (record, segment)
+
+        queue, dead_letter_queue = [], []
+        for id, (record, segment) in state.items():
+            message = Message(MessageType.SEND, record.retries, record.payload_size, record.payload, record.priority, record.deliver_at, record.compressed, record.message_id)
+            message.log_id = id
+            self.live[id] = (message, segment, record.type == DEAD)
+            (dead_letter_queue if record.type == DEAD else queue).append(message)
+
+        self._open_segment()
+        self._collect(self._collectable())
+        return queue, dead_letter_queue
+
+    def enqueue(self, message: Message) -> None:
+        """
+        Logs that the message is (again) waiting in the queue. This is also
+        used to persist a changed retry counter.
+        """
+        if message.log_id is None:
+            message.log_id = self.next_id
+            self.next_id += 1
+        self._write(message, ENQUEUE, False)
+
+    def dead(self, message: Message) -> None:
+        """
+        Logs that the message was moved to the dead letter queue.
+        """
+        self._write(message, DEAD, True)
+
+    def remove(self, message: Message) -> None:
+        """
+        Logs the removal of the message from the queues.
+        """
+        entry = self.live.pop(message.log_id, None)
+        if entry is None:
+            return
+        entry[1].live -= 1
+        self._append(message.log_id, Message(REMOVE))
+
+    def sync(self) -> asyncio.Future:
+        """
+        Returns a future which is resolved as soon as everything written so
+        far is synced to disk.
+        """
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        self._schedule_sync()
+        return waiter
+
+    def close(self) -> None:
+        """
+        Syncs and closes all open segment files. A sync still running in the
+        executor is waited for, it skips the files closed here and its
+        callback does nothing anymore.
+        """
+        if self.sync_handle is not None:
+            self.sync_handle.cancel()
+            self.sync_handle = None
+        self.closed = True
+        with self.lock:
+            for file in self.syncing_files + self.unsynced + [self.file]:
+                if file.closed:
+                    continue
+                file.flush()
+                os.fsync(file.fileno())
+                file.close()
+        self.syncing_files = []
+        self.unsynced = []
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+        self._collect(self._collectable())
+
+    def _path(self, number: int) -> str:
+        return os.path.join(self.directory, f'{number:012d}{SEGMENT_SUFFIX}')
+
+    def _read_segment(self, segment: Segment):
+        """
+        Yields all complete records of the segment and cuts off anything after
+        the last complete record.
+        """
+        with open(segment.path, 'rb') as file:
+            data = file.read()
+            # the records may only be in the page cache if the server crashed
+            # before they were synced, but older segments are deleted for them
+            os.fsync(file.fileno())
+        offset = 0
+        for offset, id, record in read_records(data):
+            segment.records += 1
+            yield id, record
+        if offset != len(data):
+            with open(segment.path, 'r+b') as file:
+                file.truncate(offset)
+        segment.size = offset
+
+    def _open_segment(self) -> None:
+        number = self.segments[-1].number + 1 if self.segments else 1
+        segment = Segment(number, self._path(number))
+        self.segments.append(segment)
+        if self.file is not None:
+            self.unsynced.append(self.file)
+        self.file = open(segment.path, 'ab')
+
+    def _write(self, message: Message, type: MessageType, dead: bool) -> None:
+        segment = self.segments[-1]
+        previous = self.live.get(message.log_id)
+        if previous is not None:
+            previous[1].live -= 1
+        self.live[message.log_id] = (message, segment, dead)
+        segment.live += 1
+        self._append(message.log_id, record_of(type, message))
+
+    def _append(self, id: int, record: Message) -> None:
+        segment = self.segments[-1]
+        data = encode_record(id, record)
+        self.file.write(data)
+        segment.records += 1
+        segment.size += len(data)
+        self.dirty = True
+        self._schedule_sync()
+        if segment.size >= self.segment_size:
+            self._open_segment()
+            self._compact()
+
+    def _collectable(self) -> list:
+        """
+        Returns the segments at the start of the log which have no live
+        messages left. Only the oldest segments are deleted, so no removal
+        record is lost while an older copy of the removed message is still
+        on disk.
+        """
+        count = 0
+        while count < len(self.segments) - 1 and self.segments[count].live == 0:
+            count += 1
+        return self.segments[:count]
+
+    def _collect(self, segments: list) -> None:
+        """
+        Deletes the given segments unless they are gone already. Everything
+        written before they ran out of live messages has to be synced.
+        """
+        for segment in segments:
+            if segment not in self.segments:
+                continue
+            self.segments.remove(segment)
+            # the file may still be open if it was not synced yet
+            for file in self.unsynced:
+                if file.name == segment.path:
+                    file.close()
+                    self.unsynced.remove(file)
+                    break
+            os.remove(segment.path)
+
+    def _compact(self) -> None:
+        """
+        Rewrites the live messages of the older segments to the newest
+        segment if only a small part of their records is still live, so a few
+        long living messages don't keep whole segments around. Denser
+        segments are skipped. The oldest segment with live messages keeps all
+        segments after it on disk, so it is rewritten whatever its ratio once
+        only a small part of all records is still live.
+        """
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            head = next((segment for segment in self.segments if segment.live > 0), None)
+            records = sum(segment.records for segment in self.segments)
+            for segment in self.segments[:-2]:
+                if segment.live == 0:
+                    continue
+                blocking = segment is head and len(self.live) <= records * self.compact_ratio
+                if segment.live > segment.records * self.compact_ratio and not blocking:
+                    continue
+                for message, _segment, dead in [entry for entry in self.live.values() if entry[1] is segment]:
+                    self._write(message, DEAD if dead else ENQUEUE, dead)
+        finally:
+            self.compacting = False
+
+    def _schedule_sync(self) -> None:
+        if self.sync_handle is None and not self.syncing:
+            self.sync_handle = asyncio.get_event_loop().call_later(self.sync_interval, self._start_sync)
+
+    def _start_sync(self) -> None:
+        self.sync_handle = None
+        self.syncing = True
+        self.dirty = False
+        waiters, self.waiters = self.waiters, []
+        files, self.unsynced = self.unsynced, []
+        self.file.flush()
+        files.append(self.file)
+        self.syncing_files = files
+        # the segments without live messages can go once the records which
+        # replaced their messages are on disk
+        collectable = self._collectable()
+        future = asyncio.get_event_loop().run_in_executor(None, _sync_files, files, self.file, self.lock)
+        future.add_done_callback(lambda f: self._finish_sync(f, waiters, collectable))
+
+    def _finish_sync(self, future: asyncio.Future, waiters: list, collectable: list) -> None:
+        if self.closed:
+            # close synced everything and collected the segments itself
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            return
+        self.syncing = False
+        self.syncing_files = []
+        if future.exception() is None:
+            self._collect(collectable)
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if future.exception() is not None:
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(None)
+        if self.waiters or self.dirty:
+            self._schedule_sync()
+
+
+
+#
+# --- Functions ---
+#
+def record_of(type: MessageType, message: Message) -> Message:
+    """
+    Returns the record of the given type for the message. REMOVE records
+    don't need the message itself.
+    """
+    if type == REMOVE:
+        return Message(REMOVE)
+    return Message(type, message.retries, message.payload_size, message.payload, message.priority, message.deliver_at, message.compressed, message.message_id)
+
+
+def encode_record(id: int, record: Message) -> bytes:
+    """
+    Encodes a record as it is written to the log, prefixed by the message id
+    and the checksum of the encoded record.
+    """
+    data = record.encode()
+    return RECORD.pack(id, zlib.crc32(data)) + data
+
+
+def read_records(data: bytes):
+    """
+    Yields the end offset, the message id and the record of every complete
+    record in data and stops at the first incomplete or corrupt record.
+    """
+    offset = 0
+    while offset + RECORD.size + HEADER.size <= len(data):
+        id, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        mv, _type, retries, size = HEADER.unpack_from(data, start)
+        end = start + HEADER.size + (size & SIZE_MASK)
+        if mv != MAGIC_VALUE or end > len(data) or zlib.crc32(data[start:end]) != crc:
+            return
+        offset = end
+        yield offset, id, Message.decode(_type, retries, size, data[start + HEADER.size:end])
+
+
+def _sync_files(files: list, active, lock: threading.Lock) -> None:
+    """
+    Flushes and syncs the given files to disk and closes all of them except
+    the active segment. This is run in an executor to not block the loop,
+    files closed by the log in the meantime are skipped.
+    """
+    with lock:
+        for file in files:
+            if file.closed:
+                continue
+            if file is not active:
+                file.flush()
+            os.fsync(file.fileno())
+            if file is not active:
+                file.close()